@@ -0,0 +1,838 @@
+import os
+import re
+import sys
+import json
+import time
+import wave
+import random
+import asyncio
+import multiprocessing
+import tempfile
+import subprocess
+from queue import Queue
+from difflib import SequenceMatcher
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+import whisper
+from whisper.audio import CHUNK_LENGTH
+from whisper.decoding import DecodingResult
+from whisper.model import Whisper, ModelDimensions
+from whisper.tokenizer import get_tokenizer
+
+from Decoding import transcribe_chunks, transcribe_recording, transcribe_sliding, decode_speculative, \
+    load_audio_window, iterate_chunk_file_mels, iterate_recording_mels, compute_log_mel, split_timestamp_segments, \
+    iterate_block_transcription, MEL_MARGIN_FRAMES
+from ChunkRecords import ChunkRecordWriter, ChunkRecordReader
+from Tools import collapse_repetitions, knit_texts, knit_tokens, iterate_knitted_texts, process_file, split_audio, \
+    convert_to_duration, get_file_duration, get_piece_count, TranscriptionJob, OverlapTracer, StageProfiler, \
+    PIECE_LENGTH, OVERLAP_SECONDS
+
+# Define the speaking rate of synthetic transcripts
+WORDS_PER_SECOND = 2.5
+
+
+# Function to generate synthetic chunk texts that are hard for repetition detection
+# PARAMS:
+# word_count (int): number of words of the generated text
+# RETURNS: Dictionary of case name (string) to generated text (string)
+def generate_repetition_cases(word_count, seed=0):
+    rng = random.Random(seed)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    sentence = "and then we went back to the market to buy some more".split()
+    return {
+        # no repetitions and no digits at all: every position makes the regex try every group length
+        "no repeats": " ".join("".join(rng.choice(letters) for _ in range(rng.randint(2, 9)))
+                               for _ in range(word_count)),
+        # hallucinated loop in which every repetition differs slightly: nothing to collapse, lots to backtrack
+        "near repeats": " ".join(word + ("s" if i % 17 == 0 else "") for i, word in
+                                 enumerate(sentence[i % len(sentence)] for i in range(word_count))),
+        # exact hallucinated loop of one sentence
+        "exact loop": " ".join(sentence[i % len(sentence)] for i in range(word_count)),
+        # exact loop of a sentence containing digits (not detected by the regex)
+        "loop with digits": " ".join((sentence[:5] + ["chapter", "12."])[i % 7] for i in range(word_count)),
+    }
+
+
+# Function to compare the repetition collapsing with the previously used regex on growing synthetic inputs
+# PARAMS:
+# word_counts (list of int): lengths of the generated texts in words
+def benchmark_repetition_collapsing(word_counts=(250, 500, 1000, 2000)):
+    pattern = re.compile(r'(\D+?)\1{2,}')
+    print(f"{'case':<18}{'words':>7}{'chars':>8}{'regex [s]':>12}{'words [s]':>12}"
+          f"{'regex len':>11}{'words len':>11}")
+    for word_count in word_counts:
+        for case, text in generate_repetition_cases(word_count).items():
+            start_time = time.perf_counter()
+            regex_result = pattern.sub(r'\1', text)
+            regex_time = time.perf_counter() - start_time
+
+            start_time = time.perf_counter()
+            words_result, _ = collapse_repetitions(text)
+            words_time = time.perf_counter() - start_time
+
+            print(f"{case:<18}{word_count:>7}{len(text):>8}{regex_time:>12.4f}{words_time:>12.4f}"
+                  f"{len(regex_result):>11}{len(words_result):>11}")
+
+
+# Function to generate a synthetic transcript and the overlapping chunk texts Whisper would produce for it.
+# Every chunk contains the words spoken from its start time for piece_length + overlap_seconds seconds. Words at the
+# borders of a chunk are cut off and some words are misheard, so successive chunks disagree slightly on the overlap.
+# PARAMS:
+# chunk_count (int): number of chunks to generate
+# noise (float): probability of a word being misheard within a chunk
+# piece_length, overlap_seconds (int): chunking parameters (see Tools.TranscriptionJob)
+# RETURNS: Tuple of the full transcript (string) and a list of chunk texts (string)
+def generate_overlapping_chunks(chunk_count, noise=0.03, seed=0, piece_length=PIECE_LENGTH,
+                                overlap_seconds=OVERLAP_SECONDS):
+    rng = random.Random(seed)
+    vocabulary = ("we think that the model should transcribe every recording with as few errors as possible while "
+                  "keeping the duration of the whole process short enough for daily use in lectures and meetings "
+                  "where people speak about international cooperation, renewable energy and public transport").split()
+    total_words = int((chunk_count * piece_length + overlap_seconds) * WORDS_PER_SECOND)
+    words = [rng.choice(vocabulary) for _ in range(total_words)]
+
+    chunks = []
+    for i in range(chunk_count):
+        first = int(i * piece_length * WORDS_PER_SECOND)
+        last = int((i * piece_length + piece_length + overlap_seconds) * WORDS_PER_SECOND)
+        chunk_words = words[first:last]
+        for j in range(len(chunk_words)):
+            if rng.random() < noise:
+                chunk_words[j] = rng.choice(vocabulary)
+        # cut off the border words half way through
+        if i > 0 and chunk_words:
+            chunk_words[0] = chunk_words[0][len(chunk_words[0]) // 2:]
+        if i < chunk_count - 1 and chunk_words:
+            chunk_words[-1] = chunk_words[-1][:len(chunk_words[-1]) // 2 + 1]
+        chunks.append(" ".join(chunk_words))
+    return " ".join(words), chunks
+
+
+# Simple stand-in for Whisper's tokenizer: every word becomes one or two tokens that carry the preceding space
+class SyntheticTokenizer:
+    def __init__(self):
+        self.vocabulary = {}
+        self.pieces = []
+
+    def _token(self, piece):
+        if piece not in self.vocabulary:
+            self.vocabulary[piece] = len(self.pieces)
+            self.pieces.append(piece)
+        return self.vocabulary[piece]
+
+    def encode(self, text):
+        tokens = []
+        for word in text.split():
+            if len(word) > 6:
+                tokens += [self._token(" " + word[:4]), self._token(word[4:])]
+            else:
+                tokens.append(self._token(" " + word))
+        return tokens
+
+    def decode(self, tokens):
+        return "".join(self.pieces[token] for token in tokens)
+
+
+# Function to compare stitching on characters (knit_texts) with stitching on token IDs (knit_tokens)
+# PARAMS:
+# chunk_counts (list of int): number of chunks per run
+def benchmark_stitching(chunk_counts=(20, 80, 240)):
+    print(f"{'chunks':>7}{'chars':>9}{'tokens':>9}{'texts [s]':>12}{'tokens [s]':>12}"
+          f"{'texts acc.':>12}{'tokens acc.':>12}")
+    for chunk_count in chunk_counts:
+        truth, chunks = generate_overlapping_chunks(chunk_count)
+        tokenizer = SyntheticTokenizer()
+        token_chunks = [tokenizer.encode(chunk) for chunk in chunks]
+        logprobs = [-0.2] * chunk_count
+
+        start_time = time.perf_counter()
+        texts_result = knit_texts(chunks)
+        texts_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        tokens_result = knit_tokens(token_chunks, logprobs, tokenizer.decode)
+        tokens_time = time.perf_counter() - start_time
+
+        # word level similarity of the knitted results with the transcript (time stamps removed)
+        truth_words = truth.split()
+        accuracies = [SequenceMatcher(None, truth_words, re.sub(r'\[[\d:]+]', '', result).split(),
+                                      autojunk=False).ratio() for result in (texts_result, tokens_result)]
+
+        print(f"{chunk_count:>7}{sum(len(chunk) for chunk in chunks):>9}"
+              f"{sum(len(tokens) for tokens in token_chunks):>9}{texts_time:>12.4f}{tokens_time:>12.4f}"
+              f"{accuracies[0]:>12.4f}{accuracies[1]:>12.4f}")
+
+
+# Function to write a synthetic speech-like recording (harmonic syllables with pauses and background noise) as mp3.
+# The audio is generated in blocks of one minute, so long recordings do not need to fit into memory.
+# PARAMS:
+# filepath (string): path of the mp3 file to create
+# duration (float): length of the recording in seconds
+# silent_minutes (collection of int): minutes containing only faint background noise (no syllables)
+def generate_synthetic_audio(filepath, duration, seed=0, sample_rate=16000, silent_minutes=()):
+    rng = np.random.default_rng(seed)
+    wav_filepath = os.path.splitext(filepath)[0] + ".wav"
+    syllable_samples = int(0.2 * sample_rate)
+    with wave.open(wav_filepath, "wb") as outFile:
+        outFile.setnchannels(1)
+        outFile.setsampwidth(2)
+        outFile.setframerate(sample_rate)
+        for block_start in range(0, int(duration), 60):
+            syllables = []
+            for _ in range(int(min(60, duration - block_start) * sample_rate) // syllable_samples):
+                t = np.arange(syllable_samples) / sample_rate
+                pitch = rng.uniform(100, 250)
+                voiced = rng.random() > 0.15
+                envelope = np.sin(np.pi * t / t[-1]) * voiced
+                syllables.append(envelope * sum(np.sin(2 * np.pi * pitch * k * t) / k for k in range(1, 6)))
+            block = np.concatenate(syllables) * 0.3 + rng.normal(0, 0.01, len(syllables) * syllable_samples)
+            if block_start // 60 in silent_minutes:
+                block = rng.normal(0, 0.0001, len(block))
+            outFile.writeframes((np.clip(block, -1, 1) * 32767).astype(np.int16).tobytes())
+    subprocess.run(["ffmpeg", "-y", "-loglevel", "error", "-i", wav_filepath, "-c:a", "libmp3lame", filepath],
+                   check=True)
+    os.remove(wav_filepath)
+
+
+# Deterministic stand-in for a Whisper model. Returns the synthetic text of the next chunk (see
+# generate_overlapping_chunks) for every decoded spectrogram after a fixed latency, so successive outputs overlap
+# just like real chunk transcriptions. Provides everything Decoding.transcribe_chunks uses of a Whisper model.
+class StubWhisperModel:
+    def __init__(self, chunk_texts, latency=0.05, n_mels=128):
+        self.chunk_texts = chunk_texts
+        self.latency = latency
+        self.dims = SimpleNamespace(n_mels=n_mels)
+        self.device = "cpu"
+        self.is_multilingual = True
+        self.num_languages = 100
+        self.tokenizer = get_tokenizer(True, num_languages=100, language="en", task="transcribe")
+        self.decoded_chunks = 0
+
+    def detect_language(self, mel):
+        return None, {"en": 1.0}
+
+    def decode(self, mel, options):
+        time.sleep(self.latency)
+        text = self.chunk_texts[self.decoded_chunks % len(self.chunk_texts)]
+        self.decoded_chunks += 1
+        return DecodingResult(audio_features=None, language="en", tokens=self.tokenizer.encode(" " + text),
+                              text=text, avg_logprob=-0.2, no_speech_prob=0.01)
+
+
+# Deterministic stand-in for model.transcribe: splits the given audio into segments of segment_seconds (the last one
+# ends with the audio), so the segments of a correct block transcription cover the recording without gaps
+class StubTranscribeModel:
+    def __init__(self, segment_seconds=5.0):
+        self.segment_seconds = segment_seconds
+        self.calls = 0
+
+    def transcribe(self, audio, initial_prompt=None, **decoding_options):
+        self.calls += 1
+        audio_duration = len(audio) / 16000
+        starts = np.arange(0, audio_duration, self.segment_seconds)
+        return {"language": "en", "segments": [{"start": float(start), "end": float(min(start + self.segment_seconds,
+                                                                                          audio_duration)),
+                                                "text": f" segment {index}"} for index, start in enumerate(starts)]}
+
+
+# Function to check the block transcription of main.py's bounded-memory mode (Decoding.iterate_block_transcription)
+# on synthetic mp3 recordings with a stub model: the segments have to follow each other without gaps up to the end of
+# the decoded audio (ffprobe reports slightly more for mp3 files), with one call of model.transcribe per block.
+# PARAMS:
+# durations (tuple of float): lengths of the synthetic recordings in seconds
+# block_seconds (float): length of the blocks (more than 2 * CHUNK_LENGTH)
+def check_block_transcription(durations=(125, 601), block_seconds=70, directory=None):
+    directory = directory or tempfile.mkdtemp(prefix="benchmark_")
+    passed = True
+    for duration in durations:
+        source_filepath = os.path.join(directory, f"synthetic{int(duration)}.mp3")
+        generate_synthetic_audio(source_filepath, duration)
+        reported_duration = get_file_duration(source_filepath)
+        decoded_duration = len(load_audio_window(source_filepath, 0, reported_duration + 1)) / 16000
+        model = StubTranscribeModel()
+        segments = list(iterate_block_transcription(model, source_filepath, reported_duration, block_seconds))
+        contiguous = all(np.isclose(previous[1], current[0]) for previous, current in zip(segments, segments[1:]))
+        complete = bool(segments) and segments[0][0] == 0 and np.isclose(segments[-1][1], decoded_duration, atol=0.05)
+        # every block but the last moves on by at least block_seconds - CHUNK_LENGTH
+        call_limit = int(np.ceil(max(decoded_duration - block_seconds, 0) / (block_seconds - CHUNK_LENGTH))) + 1
+        correct = contiguous and complete and model.calls <= call_limit
+        print(f"{duration}s (ffprobe {reported_duration:.3f}s, decoded {decoded_duration:.3f}s): "
+              f"{len(segments)} segments up to {segments[-1][1] if segments else 0:.2f}s, "
+              f"{'contiguous' if contiguous else 'WITH GAPS'}, {model.calls} calls of transcribe "
+              f"(at most {call_limit} expected)")
+        passed = passed and correct
+    print("Block transcription " + ("covers the recordings." if passed else "does NOT cover the recordings."))
+    return passed
+
+
+# Function to run the whole chunked pipeline (process_file -> transcribe_chunks -> chunk records -> knit_texts) on
+# synthetic audio with a stub model, so I/O and orchestration can be measured on CPU only, independent of the model.
+# PARAMS:
+# duration (float): length of the synthetic recording in seconds
+# latency (float): simulated decoding time per chunk in seconds
+# directory (string): working directory for audio and chunks (temporary directory if None)
+# trace_memory (bool): whether to trace Python allocations per stage (slows down pure Python stages)
+# RETURNS: StageProfiler with the measurements of all stages
+def benchmark_pipeline(duration=600, latency=0.05, directory=None, trace_memory=True):
+    directory = directory or tempfile.mkdtemp(prefix="benchmark_")
+    source_filepath = os.path.join(directory, "synthetic.mp3")
+    profiler = StageProfiler(duration, trace_memory)
+
+    with profiler.stage("synthesize"):
+        generate_synthetic_audio(source_filepath, duration)
+    with profiler.stage("split"):
+        chunk_filepaths = process_file(source_filepath, Queue(), Queue())
+    _, chunk_texts = generate_overlapping_chunks(len(chunk_filepaths))
+    model = StubWhisperModel(chunk_texts, latency)
+    records_filepath = os.path.join(directory, "synthetic_chunks.jsonl")
+    with profiler.stage("decode"):
+        with ChunkRecordWriter(records_filepath) as record_writer:
+            transcribe_chunks(model, chunk_filepaths, Queue(), record_writer=record_writer)
+    with profiler.stage("knit"):
+        result = knit_texts(ChunkRecordReader(records_filepath).texts())
+    with profiler.stage("write"):
+        with open(os.path.join(directory, "synthetic.txt"), "w", encoding="utf-8") as outFile:
+            outFile.write(result)
+
+    print(f"Pipeline benchmark: {duration} seconds of audio, {len(chunk_filepaths)} chunks, "
+          f"{latency} seconds simulated decoding per chunk, working directory {directory}")
+    profiler.report()
+    return profiler
+
+
+# Function to run one job of the chunked pipeline on a synthetic recording with a stub model: split_audio and
+# transcribe_chunks for jobs with an even seed, transcribe_recording for the others, then knit_texts with tracing
+# RETURNS: Dictionary of everything the job produced (piece count, chunk starts, knitted text and trace records)
+def _run_stress_job(source_filepath, duration, directory, job, seed, latency):
+    os.makedirs(directory, exist_ok=True)
+    trace_filepath = os.path.join(directory, "trace.jsonl")
+    records_filepath = os.path.join(directory, "chunks.jsonl")
+    job.overlap_tracer = OverlapTracer(trace_filepath, include_texts=True)
+    _, chunk_texts = generate_overlapping_chunks(get_piece_count(duration, job), seed=seed,
+                                                 piece_length=job.piece_length, overlap_seconds=job.overlap_seconds)
+    model = StubWhisperModel(chunk_texts, latency)
+    with ChunkRecordWriter(records_filepath) as record_writer:
+        if seed % 2 == 0:
+            chunk_filepaths = split_audio(source_filepath, directory, Queue(), Queue(), job)
+            transcribe_chunks(model, chunk_filepaths, Queue(), record_writer=record_writer, job=job)
+        else:
+            job.piece_count = get_piece_count(duration, job)
+            transcribe_recording(model, source_filepath, duration, Queue(), record_writer=record_writer,
+                                 block_seconds=60, job=job)
+    text = knit_texts(ChunkRecordReader(records_filepath).texts(), job)
+    job.overlap_tracer.close()
+    with open(trace_filepath, "r", encoding="utf-8") as inFile:
+        trace = [json.loads(line) for line in inFile]
+    return {"piece_count": job.piece_count, "text": text, "trace": trace,
+            "starts": [record["start"] for record in ChunkRecordReader(records_filepath)]}
+
+
+# Function to check that transcription jobs with different parameters do not interfere when running at the same time.
+# Every job gets its own chunking and knitting parameters (see Tools.TranscriptionJob), stub model and overlap tracer.
+# All jobs are run one after another first, then all at once on threads and as asyncio tasks, and every concurrent
+# result has to be identical to the job's sequential result.
+# PARAMS:
+# job_count (int): number of jobs to run at the same time
+# duration (float): length of the synthetic recording in seconds
+# latency (float): simulated decoding time per chunk in seconds
+# RETURNS: True if no job was affected by any other job
+def stress_test_jobs(job_count=8, duration=90, latency=0.01, directory=None):
+    directory = directory or tempfile.mkdtemp(prefix="benchmark_")
+    source_filepath = os.path.join(directory, "synthetic.mp3")
+    generate_synthetic_audio(source_filepath, duration)
+
+    def create_job(seed):
+        return TranscriptionJob(piece_length=(10, 15, 20, 30)[seed % 4], overlap_seconds=(3, 5, 8)[seed % 3],
+                                minimum_match_threshold=(0.4, 0.5, 0.6)[seed % 3],
+                                maximum_overlap_length=(150, 200, 300)[seed % 3], split_workers=1 + seed % 2)
+
+    def run(label, seed):
+        return _run_stress_job(source_filepath, duration, os.path.join(directory, f"{label}{seed}"),
+                               create_job(seed), seed, latency)
+
+    async def run_tasks():
+        return await asyncio.gather(*[asyncio.to_thread(run, "task", seed) for seed in range(job_count)])
+
+    start_time = time.perf_counter()
+    sequential_results = [run("sequential", seed) for seed in range(job_count)]
+    sequential_time = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=job_count) as executor:
+        threaded_results = list(executor.map(lambda seed: run("thread", seed), range(job_count)))
+    threaded_time = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    task_results = asyncio.run(run_tasks())
+    task_time = time.perf_counter() - start_time
+
+    isolated = True
+    for seed, expected in enumerate(sequential_results):
+        job = create_job(seed)
+        # the job's own parameters have to show in its results
+        consistent = (expected["piece_count"] == get_piece_count(duration, job)
+                      and expected["starts"] == [i * job.piece_length for i in range(expected["piece_count"])]
+                      and len(expected["trace"]) == expected["piece_count"] - 1)
+        identical = threaded_results[seed] == expected and task_results[seed] == expected
+        isolated &= consistent and identical
+        print(f"job {seed}: piece length {job.piece_length}s, overlap {job.overlap_seconds}s, "
+              f"{expected['piece_count']} chunks, {len(expected['trace'])} traced boundaries, "
+              f"{'consistent' if consistent else 'INCONSISTENT'}, "
+              f"threads and tasks {'identical' if identical else 'DIFFERENT'}")
+    print(f"{job_count} jobs: sequential {sequential_time:.1f}s, threads {threaded_time:.1f}s, "
+          f"asyncio tasks {task_time:.1f}s, {'no cross-talk' if isolated else 'CROSS-TALK between jobs'}")
+    return isolated
+
+
+# Function run in a fresh process by benchmark_memory: profiles the bounded-memory chunked pipeline on one synthetic
+# recording and, for comparison, what holding the whole recording costs (as model.transcribe does)
+def _profile_memory(source_filepath, duration, directory, compare_whole):
+    profiler = StageProfiler(duration, trace_memory=False)
+    job = TranscriptionJob(bounded_memory=True)
+    records_filepath = os.path.join(directory, f"chunks{int(duration)}.jsonl")
+    with profiler.stage("duration"):
+        get_file_duration(source_filepath)
+    _, chunk_texts = generate_overlapping_chunks(get_piece_count(duration, job))
+    model = StubWhisperModel(chunk_texts, latency=0)
+    with profiler.stage("decode"), ChunkRecordWriter(records_filepath) as record_writer:
+        transcribe_recording(model, source_filepath, duration, Queue(), record_writer=record_writer, job=job)
+    del model, chunk_texts
+    with profiler.stage("knit"), open(os.path.join(directory, f"result{int(duration)}.txt"), "w",
+                                      encoding="utf-8") as outFile:
+        for part in iterate_knitted_texts(ChunkRecordReader(records_filepath).texts(), job):
+            outFile.write(part)
+    if compare_whole:
+        with profiler.stage("whole"):
+            whisper.log_mel_spectrogram(whisper.load_audio(source_filepath), n_mels=128)
+    print(f"{duration / 3600:.1f} hours of audio, {len(ChunkRecordReader(records_filepath))} chunks:")
+    profiler.report()
+
+
+# Function to check that the peak resident set size of the bounded-memory chunked pipeline (slicing the spectrograms
+# out of the recording, streaming the chunk records and the knitted text) does not grow with the recording's length.
+# Every recording is profiled in a fresh process, so memory kept by earlier runs does not distort the peaks.
+# PARAMS:
+# durations (list of float): lengths of the synthetic recordings in seconds
+# whole_limit (float): longest recording to also load as a whole for comparison (grows with the length)
+def benchmark_memory(durations=(1800, 7200, 36000), whole_limit=3600, directory=None):
+    directory = directory or tempfile.mkdtemp(prefix="benchmark_")
+    context = multiprocessing.get_context("spawn")
+    for duration in durations:
+        source_filepath = os.path.join(directory, f"synthetic{int(duration)}.mp3")
+        generate_synthetic_audio(source_filepath, duration)
+        process = context.Process(target=_profile_memory,
+                                  args=(source_filepath, duration, directory, duration <= whole_limit))
+        process.start()
+        process.join()
+
+
+# Function to split like split_audio did before: -ss after -i (ffmpeg decodes everything up to the chunk's start)
+# and one chunk after the other. Only kept as reference for benchmark_splitting.
+def split_audio_output_seeking(input_filepath, output_directory, chunk_count):
+    for i in range(chunk_count):
+        subprocess.run(["ffmpeg", "-nostdin", "-loglevel", "error", "-y", "-i", input_filepath,
+                        "-ss", convert_to_duration(i * PIECE_LENGTH),
+                        "-t", convert_to_duration(PIECE_LENGTH + OVERLAP_SECONDS),
+                        "-c:a", "libmp3lame", f"{output_directory}/audio{i}.mp3"], check=True)
+
+
+# Function to compare the splitting time of split_audio with the previous sequential output seeking for growing
+# recording lengths. With input seeking the time per recorded minute should stay constant.
+# PARAMS:
+# durations (list of float): lengths of the synthetic recordings in seconds
+# directory (string): working directory (temporary directory if None)
+def benchmark_splitting(durations=(300, 900, 1800), directory=None):
+    directory = directory or tempfile.mkdtemp(prefix="benchmark_")
+    print(f"{'duration [s]':>13}{'chunks':>8}{'output seeking [s]':>20}{'split_audio [s]':>17}"
+          f"{'per minute [s]':>16}")
+    for duration in durations:
+        source_filepath = os.path.join(directory, f"synthetic{int(duration)}.mp3")
+        generate_synthetic_audio(source_filepath, duration)
+        chunk_directories = [os.path.join(directory, f"{method}{int(duration)}") for method in ["output", "input"]]
+        for chunk_directory in chunk_directories:
+            os.makedirs(chunk_directory, exist_ok=True)
+
+        start_time = time.perf_counter()
+        chunk_filepaths = split_audio(source_filepath, chunk_directories[1], Queue(), Queue())
+        input_seeking_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        split_audio_output_seeking(source_filepath, chunk_directories[0], len(chunk_filepaths))
+        output_seeking_time = time.perf_counter() - start_time
+
+        print(f"{duration:>13}{len(chunk_filepaths):>8}{output_seeking_time:>20.2f}{input_seeking_time:>17.2f}"
+              f"{input_seeking_time / duration * 60:>16.3f}")
+
+
+# Function to check the log-Mel windows sliced out of the recording's spectrogram (Decoding.iterate_recording_mels)
+# against the spectrograms computed for every padded chunk on its own, and to compare the time both take.
+# Only the MEL_MARGIN_FRAMES frames at the borders of a chunk can differ: there the chunk's own spectrogram sees the
+# STFT's reflection padding and the zero padding instead of the neighbouring audio of the recording.
+# PARAMS:
+# duration (float): length of the synthetic recording in seconds
+# n_mels (int): number of Mel bins (128 for large-v3, 80 for all other models)
+# block_seconds (tuple of float): block lengths to compute the recording's spectrogram with
+def benchmark_mel(duration=1800, n_mels=128, block_seconds=(60, 120, 600), directory=None):
+    directory = directory or tempfile.mkdtemp(prefix="benchmark_")
+    source_filepath = os.path.join(directory, f"synthetic{int(duration)}.mp3")
+    generate_synthetic_audio(source_filepath, duration)
+    chunk_count = get_piece_count(duration)
+    chunk_samples = (PIECE_LENGTH + OVERLAP_SECONDS) * whisper.audio.SAMPLE_RATE
+    chunk_frames = chunk_samples // whisper.audio.HOP_LENGTH
+
+    # spectrogram computation only, from the decoded waveform
+    audio = whisper.load_audio(source_filepath)
+    start_time = time.perf_counter()
+    chunk_mels = [whisper.log_mel_spectrogram(whisper.pad_or_trim(audio[i * PIECE_LENGTH * whisper.audio.SAMPLE_RATE:
+                                                                        i * PIECE_LENGTH * whisper.audio.SAMPLE_RATE
+                                                                        + chunk_samples]), n_mels=n_mels)
+                  for i in range(chunk_count)]
+    per_chunk_time = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    compute_log_mel(audio, (n_mels,))
+    whole_time = time.perf_counter() - start_time
+    print(f"{chunk_count} chunks of {duration} s: spectrograms per padded chunk {per_chunk_time:.2f} s, "
+          f"of the whole recording {whole_time:.2f} s ({per_chunk_time / whole_time:.1f}x)")
+
+    # complete pipelines: splitting into chunk files and loading them against slicing blocks of the recording
+    chunk_directory = os.path.join(directory, f"chunks{int(duration)}")
+    os.makedirs(chunk_directory, exist_ok=True)
+    start_time = time.perf_counter()
+    for _ in iterate_chunk_file_mels(split_audio(source_filepath, chunk_directory, Queue(), Queue()), (n_mels,)):
+        pass
+    print(f"{'split_audio + chunk files':<28}{time.perf_counter() - start_time:>8.2f} s")
+
+    parity = True
+    for block in block_seconds:
+        start_time = time.perf_counter()
+        sliced_mels = [mels[0] for mels in iterate_recording_mels(source_filepath, duration, (n_mels,), block)]
+        elapsed_time = time.perf_counter() - start_time
+
+        interior_difference = border_difference = 0.0
+        for i, (chunk_mel, sliced_mel) in enumerate(zip(chunk_mels, sliced_mels)):
+            # the last chunk may end before chunk_frames with the recording
+            end_frame = min(chunk_frames, len(audio) // whisper.audio.HOP_LENGTH - i * PIECE_LENGTH * 100)
+            difference = (chunk_mel - sliced_mel).abs()
+            interior_difference = max(interior_difference,
+                                      difference[:, MEL_MARGIN_FRAMES:end_frame - MEL_MARGIN_FRAMES].max().item())
+            border_difference = max(border_difference, difference.max().item())
+        parity = parity and len(sliced_mels) == chunk_count and interior_difference < 1e-4
+        print(f"{f'recording, {block} s blocks':<28}{elapsed_time:>8.2f} s, maximum difference inside the chunks "
+              f"{interior_difference:.2e}, at their borders {border_difference:.2f}")
+    print("Sliced spectrograms " + ("match" if parity else "DO NOT match") + " the spectrograms of the chunks.")
+    return parity
+
+
+# Function to compare decoding the chunks of a synthetic recording with the encoder and decoder running one after
+# another and as two pipeline stages (Decoding.EncoderPipeline), with a randomly initialised model on the CPU.
+# The transcripts have to be identical, the pipeline reports how busy each stage was.
+# PARAMS:
+# duration (float): length of the synthetic recording in seconds
+# layers, state (int): size of the stub model (see create_speculative_stub_models)
+# sample_len (int): maximum number of tokens decoded per chunk
+def benchmark_encoder_pipeline(duration=300, layers=4, state=384, sample_len=32, directory=None):
+    directory = directory or tempfile.mkdtemp(prefix="benchmark_")
+    source_filepath = os.path.join(directory, f"synthetic{int(duration)}.mp3")
+    generate_synthetic_audio(source_filepath, duration)
+    model, _ = create_speculative_stub_models(layers, state)
+    decoding_options = {"sample_len": sample_len, "language": "en"}
+
+    start_time = time.perf_counter()
+    sequential_results = transcribe_recording(model, source_filepath, duration, Queue(),
+                                              decoding_options=decoding_options)[0]
+    sequential_time = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    pipelined_results = transcribe_recording(model, source_filepath, duration, Queue(),
+                                             decoding_options=decoding_options, pipeline=True)[0]
+    pipelined_time = time.perf_counter() - start_time
+
+    identical = all(sequential.tokens == pipelined.tokens
+                    for sequential, pipelined in zip(sequential_results, pipelined_results))
+    print(f"{len(sequential_results)} chunks on {os.cpu_count()} cores: sequential {sequential_time:.1f}s, "
+          f"pipelined {pipelined_time:.1f}s ({sequential_time / pipelined_time:.2f}x), "
+          f"transcripts {'identical' if identical else 'DIFFERENT'}")
+    return identical
+
+
+# Function to check skipping chunks without speech (see TranscriptionJob.skip_no_speech) with a randomly initialised
+# model on a synthetic recording with silent minutes: exactly the chunks within them have to be skipped by the energy
+# check, and the other chunks have to be decoded exactly as without skipping, with the same no-speech probability as
+# the first decoder step computes. Randomly initialised models never predict the no-speech token (its probability
+# is 0), so the no-speech check is exercised with a negative threshold, which has to skip every chunk that is not
+# silent.
+# PARAMS:
+# duration (float): length of the synthetic recording in seconds
+# silent_minutes (collection of int): minutes of the recording without syllables
+# sample_len (int): maximum number of tokens decoded per chunk
+def benchmark_no_speech(duration=300, silent_minutes=(1, 2, 3), sample_len=32, directory=None):
+    directory = directory or tempfile.mkdtemp(prefix="benchmark_")
+    source_filepath = os.path.join(directory, f"synthetic{int(duration)}_silent.mp3")
+    generate_synthetic_audio(source_filepath, duration, silent_minutes=silent_minutes)
+    model, _ = create_speculative_stub_models(layers=4)
+    decoding_options = {"sample_len": sample_len, "language": "en"}
+    job = TranscriptionJob()
+    # chunks within the silent minutes, leaving a second for the spectrogram margin and the delay of the mp3 encoder
+    expected_silent = [idx for idx in range(get_piece_count(duration, job))
+                       if int(idx * job.piece_length - 1) // 60 in silent_minutes
+                       and int(idx * job.piece_length + job.chunk_length()) // 60 in silent_minutes]
+
+    start_time = time.perf_counter()
+    results = transcribe_recording(model, source_filepath, duration, Queue(), decoding_options=decoding_options,
+                                   job=job)[0]
+    full_time = time.perf_counter() - start_time
+    passed = True
+    for pipeline in (False, True):
+        gated_job = TranscriptionJob(skip_no_speech=True)
+        start_time = time.perf_counter()
+        gated_results = transcribe_recording(model, source_filepath, duration, Queue(),
+                                             decoding_options=decoding_options, pipeline=pipeline, job=gated_job)[0]
+        gated_time = time.perf_counter() - start_time
+        skipped = [idx for idx, _ in gated_job.skipped_chunks]
+        identical = all(gated.tokens == result.tokens and np.isclose(gated.no_speech_prob, result.no_speech_prob)
+                        for idx, (gated, result) in enumerate(zip(gated_results, results)) if idx not in skipped)
+        empty = all(not gated_results[idx].tokens and not gated_results[idx].text for idx in skipped)
+        # knitting has to leave the text before a skipped chunk as it is and only add the chunk's timestamp
+        texts = [result.text for result in gated_results]
+        knitted = knit_texts(texts)
+        knitted_intact = all(
+            knitted.startswith(f"{knit_texts(texts[:idx])} [{convert_to_duration(idx * job.piece_length)}]")
+            for idx in skipped if idx > 0)
+        print(f"pipeline {pipeline}: skipped {len(skipped)}/{len(results)} chunks "
+              f"({'as expected' if skipped == expected_silent else f'EXPECTED {expected_silent}, GOT {skipped}'}), "
+              f"other chunks {'identical' if identical else 'DIFFERENT'}, skipped chunks "
+              f"{'empty' if empty else 'NOT EMPTY'}, knitted text {'intact' if knitted_intact else 'BROKEN'}, "
+              f"{full_time:.1f}s without and {gated_time:.1f}s with skipping")
+        passed = passed and skipped == expected_silent and identical and empty and knitted_intact
+
+    probability_job = TranscriptionJob(skip_no_speech=True, no_speech_threshold=-1.0)
+    transcribe_recording(model, source_filepath, duration, Queue(), decoding_options=decoding_options,
+                         job=probability_job)
+    reasons = dict(probability_job.skipped_chunks)
+    no_speech_skipped = all(reasons.get(idx) == ("silence" if idx in expected_silent else "no speech")
+                            for idx in range(len(results)))
+    print(f"negative no-speech threshold: {'every chunk skipped' if no_speech_skipped else 'NOT every chunk skipped'}")
+    passed = passed and no_speech_skipped
+    print("Skipping chunks without speech " + ("works." if passed else "FAILED."))
+    return passed
+
+
+# Function to compare the three transcription modes on one recording with a real model: whole file
+# (model.transcribe as in main.py), fixed overlapping chunks with knitting and the timestamp-driven sliding window
+# (both as in main_chunked.py). Reports wall time, real-time factor, decoder calls and the word level similarity of
+# each result with the whole file transcription.
+# PARAMS:
+# model (Whisper): loaded Whisper model
+# filepath (string): path of an mp3/m4a/mp4 recording
+def benchmark_modes(model, filepath):
+    duration = get_file_duration(filepath)
+    measurements = []
+
+    start_time = time.perf_counter()
+    whole_result = model.transcribe(filepath, fp16=False)
+    measurements.append(("whole", time.perf_counter() - start_time, len(whole_result["segments"]),
+                         whole_result["text"]))
+
+    start_time = time.perf_counter()
+    chunk_filepaths = process_file(filepath, Queue(), Queue())
+    results, _, _, _ = transcribe_chunks(model, chunk_filepaths, Queue())
+    chunked_result = knit_texts(result.text for result in results)
+    measurements.append(("chunked", time.perf_counter() - start_time, len(chunk_filepaths), chunked_result))
+
+    start_time = time.perf_counter()
+    sliding_result, _, window_count = transcribe_sliding(model, filepath, duration, Queue())
+    measurements.append(("sliding", time.perf_counter() - start_time, window_count, sliding_result))
+
+    whole_words = whole_result["text"].split()
+    print(f"{'mode':<10}{'wall [s]':>10}{'RTF':>9}{'decodes':>9}{'words':>8}{'similarity':>12}")
+    for mode, wall_time, decodes, text in measurements:
+        words = re.sub(r'\[[\d:]+]', '', text).split()
+        similarity = SequenceMatcher(None, whole_words, words, autojunk=False).ratio()
+        print(f"{mode:<10}{wall_time:>10.2f}{wall_time / duration:>9.3f}{decodes:>9}{len(words):>8}"
+              f"{similarity:>12.3f}")
+    return measurements
+
+
+# Function to compare the three transcription modes with a randomly initialised model (see
+# create_speculative_stub_models) on a synthetic recording, so the harness and the throughput of the modes can be
+# measured without downloading weights. The transcripts of a random model are meaningless, so are their similarities.
+# PARAMS:
+# duration (float): length of the synthetic recording in seconds
+# layers, state (int): size of the stub model
+def benchmark_modes_stubs(duration=300, layers=4, state=384, directory=None):
+    directory = directory or tempfile.mkdtemp(prefix="benchmark_")
+    source_filepath = os.path.join(directory, f"synthetic{int(duration)}.mp3")
+    generate_synthetic_audio(source_filepath, duration)
+    model, _ = create_speculative_stub_models(layers, state)
+    return benchmark_modes(model, source_filepath)
+
+
+# Function to check how split_timestamp_segments splits a window into segments and how far the sliding window
+# advances, on token sequences with consecutive timestamps, a single timestamp at the end and no timestamps
+# RETURNS: whether all cases gave the expected segments and advance
+def check_timestamp_segments(timestamp_begin=50365, window_duration=30.0):
+    t = timestamp_begin
+    cases = {
+        # the last segment (tokens 14 and 15) is cut off by the end of the window and left for the next window
+        "consecutive timestamps": ([t, 10, 11, t + 50, t + 50, 12, 13, t + 100, t + 100, 14, 15],
+                                   [(0.0, 1.0, [10, 11]), (1.0, 2.0, [12, 13])], 2.0),
+        "consecutive timestamps, single timestamp ending": ([t, 10, 11, t + 50, t + 50, 12, 13, t + 100],
+                                                            [(0.0, 1.0, [10, 11]), (1.0, 2.0, [12, 13])],
+                                                            window_duration),
+        "single timestamp ending": ([t, 10, 11, t + 75], [(0.0, 1.5, [10, 11])], window_duration),
+        "no timestamps": ([10, 11, 12], [(0.0, window_duration, [10, 11, 12])], window_duration),
+        "no tokens": ([], [], window_duration),
+        # a segment ending right at the start of the window still moves the window on by one token step
+        "empty first segment": ([t, t, 10, 11], [(0.0, 0.0, [])], 0.02),
+    }
+    passed = True
+    for name, (tokens, expected_segments, expected_advance) in cases.items():
+        segments, advance = split_timestamp_segments(tokens, timestamp_begin, window_duration)
+        correct = (len(segments) == len(expected_segments)
+                   and all(np.isclose(start, expected_start) and np.isclose(end, expected_end)
+                           and text_tokens == expected_tokens
+                           for (start, end, text_tokens), (expected_start, expected_end, expected_tokens)
+                           in zip(segments, expected_segments))
+                   and np.isclose(advance, expected_advance))
+        print(f"{name}: {'correct' if correct else f'WRONG, got {segments} and advance {advance}'}")
+        passed = passed and correct
+    print("Timestamp segments " + ("are split correctly." if passed else "are NOT split correctly."))
+    return passed
+
+
+# Function to create a randomly initialised model and draft model (no weights to download) for speculative decoding
+# on CPU. The draft model consists of the model's first decoder block (and a one block encoder), the remaining
+# decoder blocks of the model are scaled down by divergence. With divergence None the draft model gets weights of its
+# own. Note that randomly initialised decoders mostly repeat their last input token, so even unrelated stub models
+# agree most of the time: the stubs check that the result is identical, acceptance rates need real models.
+# RETURNS: Tuple of the model and the draft model
+def create_speculative_stub_models(layers=6, state=384, divergence=0.1, seed=0):
+    torch.manual_seed(seed)
+
+    def create(n_layer):
+        return Whisper(ModelDimensions(n_mels=80, n_audio_ctx=1500, n_audio_state=state, n_audio_head=6,
+                                       n_audio_layer=n_layer, n_vocab=51865, n_text_ctx=448, n_text_state=state,
+                                       n_text_head=6, n_text_layer=n_layer)).eval()
+
+    model = create(layers)
+    draft_model = create(1)
+    if divergence is None:
+        return model, draft_model
+    model_state = model.state_dict()
+    draft_model.load_state_dict({name: model_state[name] for name in draft_model.state_dict()})
+    with torch.no_grad():
+        for block in model.decoder.blocks[1:]:
+            for layer in (block.attn.out, block.cross_attn.out, block.mlp[2]):
+                layer.weight.mul_(divergence)
+                layer.bias.mul_(divergence)
+    return model, draft_model
+
+
+# Function to compare speculative decoding with plain greedy decoding of the model on the same segments.
+# Reports whether the transcripts are identical, the acceptance rate of the draft tokens, the tokens decoded per
+# decoder pass of the model and the speedup in wall time.
+# PARAMS:
+# model (Whisper): model to reproduce
+# draft_model (Whisper): draft model proposing the tokens
+# audios (list of numpy arrays): waveforms of up to 30 seconds
+# options (DecodingOptions): greedy decoding options
+def benchmark_speculative(model, draft_model, audios, options=None, draft_length=None):
+    options = options or whisper.DecodingOptions(fp16=False)
+    extra_arguments = {} if draft_length is None else {"draft_length": draft_length}
+    totals = {"proposed": 0, "accepted": 0, "tokens": 0, "passes": 0}
+    greedy_time = speculative_time = 0.0
+    identical = 0
+    for audio in audios:
+        audio = whisper.pad_or_trim(audio)
+        mel = whisper.log_mel_spectrogram(audio, n_mels=model.dims.n_mels).to(model.device)
+        draft_mel = whisper.log_mel_spectrogram(audio, n_mels=draft_model.dims.n_mels).to(draft_model.device)
+
+        start_time = time.perf_counter()
+        greedy_result = model.decode(mel, options)
+        greedy_time += time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        speculative_result, statistics = decode_speculative(model, draft_model, mel, options, draft_mel,
+                                                            **extra_arguments)
+        speculative_time += time.perf_counter() - start_time
+
+        identical += greedy_result.tokens == speculative_result.tokens
+        for key in totals:
+            totals[key] += statistics[key]
+
+    print(f"identical: {identical}/{len(audios)}, "
+          f"acceptance rate: {totals['accepted'] / max(totals['proposed'], 1):.2f}, "
+          f"tokens per pass: {totals['tokens'] / max(totals['passes'], 1):.2f}, "
+          f"greedy: {greedy_time:.2f}s, speculative: {speculative_time:.2f}s, "
+          f"speedup: {greedy_time / speculative_time:.2f}x")
+    return identical == len(audios), totals, greedy_time / speculative_time
+
+
+# Function to check speculative decoding with stub models on CPU: the transcripts have to be identical to greedy
+# decoding for a draft sharing weights with the model and for an unrelated draft, with and without timestamps
+def benchmark_speculative_stubs(divergences=(0.05, None), segment_count=2):
+    generator = np.random.default_rng(0)
+    audios = [generator.normal(0, 0.1, CHUNK_LENGTH * 16000).astype(np.float32) for _ in range(segment_count)]
+    all_identical = True
+    for divergence in divergences:
+        model, draft_model = create_speculative_stub_models(divergence=divergence)
+        for without_timestamps in (True, False):
+            print(f"divergence {divergence}, without timestamps {without_timestamps}: ", end="")
+            options = whisper.DecodingOptions(fp16=False, language="en", without_timestamps=without_timestamps)
+            identical, _, _ = benchmark_speculative(model, draft_model, audios, options)
+            all_identical = all_identical and identical
+    print("Speculative decoding " + ("reproduces" if all_identical else "DOES NOT reproduce") + " greedy decoding.")
+    return all_identical
+
+
+# Usage:
+# python Benchmark.py                                 run the repetition and stitching benchmarks
+# python Benchmark.py pipeline [duration] [latency]   run the pipeline benchmark on synthetic audio
+# python Benchmark.py splitting                        compare splitting times for growing recording lengths
+# python Benchmark.py modes <file> [model name]        compare whole, chunked and sliding mode with a real model
+# python Benchmark.py modes                            compare the modes with a stub model on synthetic audio
+# python Benchmark.py segments                         check splitting sliding windows into timestamp segments
+# python Benchmark.py mel [duration]                   compare sliced and per chunk log-Mel spectrograms
+# python Benchmark.py pipelining [duration]            compare sequential and pipelined encoding and decoding
+# python Benchmark.py jobs [job count]                 run jobs with different parameters at the same time
+# python Benchmark.py memory [durations...]           check the peak memory of the bounded-memory mode
+# python Benchmark.py blocks                           check the block transcription of main.py with a stub model
+# python Benchmark.py nospeech [duration]             check skipping chunks without speech with a stub model
+# python Benchmark.py speculative                      check speculative decoding with stub models on CPU
+# python Benchmark.py speculative <file> [model] [draft] [windows]
+#                                                      compare speculative and greedy decoding with real models
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "pipeline":
+        benchmark_pipeline(*[float(arg) for arg in sys.argv[2:4]])
+    elif len(sys.argv) > 1 and sys.argv[1] == "splitting":
+        benchmark_splitting()
+    elif len(sys.argv) > 1 and sys.argv[1] == "pipelining":
+        benchmark_encoder_pipeline(*[float(arg) for arg in sys.argv[2:3]])
+    elif len(sys.argv) > 1 and sys.argv[1] == "jobs":
+        stress_test_jobs(*[int(arg) for arg in sys.argv[2:3]])
+    elif len(sys.argv) > 1 and sys.argv[1] == "blocks":
+        check_block_transcription()
+    elif len(sys.argv) > 1 and sys.argv[1] == "memory":
+        benchmark_memory(*([[float(arg) for arg in sys.argv[2:]]] if len(sys.argv) > 2 else []))
+    elif len(sys.argv) > 1 and sys.argv[1] == "nospeech":
+        benchmark_no_speech(*[float(arg) for arg in sys.argv[2:3]])
+    elif len(sys.argv) > 1 and sys.argv[1] == "mel":
+        benchmark_mel(*[float(arg) for arg in sys.argv[2:3]])
+    elif len(sys.argv) > 2 and sys.argv[1] == "modes":
+        benchmark_modes(whisper.load_model(sys.argv[3] if len(sys.argv) > 3 else "large-v3"), sys.argv[2])
+    elif len(sys.argv) > 1 and sys.argv[1] == "modes":
+        benchmark_modes_stubs()
+    elif len(sys.argv) > 1 and sys.argv[1] == "segments":
+        check_timestamp_segments()
+    elif len(sys.argv) > 2 and sys.argv[1] == "speculative":
+        speculative_model = whisper.load_model(sys.argv[3] if len(sys.argv) > 3 else "large-v3")
+        speculative_draft_model = whisper.load_model(sys.argv[4] if len(sys.argv) > 4 else "tiny")
+        window_count = int(sys.argv[5]) if len(sys.argv) > 5 else 8
+        benchmark_speculative(speculative_model, speculative_draft_model,
+                              [load_audio_window(sys.argv[2], i * CHUNK_LENGTH, CHUNK_LENGTH)
+                               for i in range(window_count)])
+    elif len(sys.argv) > 1 and sys.argv[1] == "speculative":
+        benchmark_speculative_stubs()
+    else:
+        benchmark_repetition_collapsing()
+        benchmark_stitching()
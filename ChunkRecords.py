@@ -0,0 +1,120 @@
+import os
+import json
+import struct
+
+# Define the layout of the index file: one unsigned 64 bit byte offset into the record file per chunk
+INDEX_ENTRY = struct.Struct("<Q")
+
+
+# Function to get the path of the index file belonging to a record file
+def get_index_filepath(records_filepath):
+    return os.path.splitext(records_filepath)[0] + ".idx"
+
+
+# Function to cut a record file and its index file back to the last completely indexed record, dropping a partly
+# written record or index entry and a record without index entry (e.g. after a crash)
+def truncate_to_index(records_filepath):
+    index_filepath = get_index_filepath(records_filepath)
+    record_count = os.path.getsize(index_filepath) // INDEX_ENTRY.size if os.path.exists(index_filepath) else 0
+    end = 0
+    if record_count:
+        with open(index_filepath, "rb") as index_file:
+            index_file.seek((record_count - 1) * INDEX_ENTRY.size)
+            offset, = INDEX_ENTRY.unpack(index_file.read(INDEX_ENTRY.size))
+        with open(records_filepath, "rb") as records_file:
+            records_file.seek(offset)
+            end = offset + len(records_file.readline())
+    with open(records_filepath, "r+b") as records_file:
+        records_file.truncate(end)
+    with open(index_filepath, "ab") as index_file:
+        index_file.truncate(record_count * INDEX_ENTRY.size)
+
+
+# Class to append one record per transcribed chunk to a JSONL file, while it is being transcribed.
+# Every record contains the chunk index, its start offset in the recording (in seconds), the text, the tokens,
+# the average log-probability and the no-speech probability. Next to the record file an index file stores the byte
+# offset of every record, so readers can jump to any chunk. Records are flushed one by one, so after a crash all
+# completely written chunks can still be read (and a resumed run can continue with append=True, which first drops
+# everything a crash left behind after the last indexed record).
+class ChunkRecordWriter:
+    def __init__(self, records_filepath, append=False):
+        if append and os.path.exists(records_filepath):
+            truncate_to_index(records_filepath)
+        mode = "ab" if append else "wb"
+        self.records_file = open(records_filepath, mode)
+        self.index_file = open(get_index_filepath(records_filepath), mode)
+
+    def append(self, index, start, text, tokens=(), avg_logprob=None, no_speech_prob=None):
+        record = {"index": index, "start": start, "text": text, "tokens": list(tokens),
+                  "avg_logprob": avg_logprob, "no_speech_prob": no_speech_prob}
+        offset = self.records_file.tell()
+        self.records_file.write(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n")
+        self.records_file.flush()
+        # only index the record after it has been written completely
+        self.index_file.write(INDEX_ENTRY.pack(offset))
+        self.index_file.flush()
+
+    # Function to append the DecodingResult of a chunk
+    def append_result(self, index, start, result):
+        self.append(index, start, result.text, result.tokens, result.avg_logprob, result.no_speech_prob)
+
+    def close(self):
+        self.records_file.close()
+        self.index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Class to read chunk records lazily: len() and reader[n] only read the index entry and the record of chunk n,
+# iterating reads one record at a time.
+class ChunkRecordReader:
+    def __init__(self, records_filepath):
+        self.records_filepath = records_filepath
+        self.index_filepath = get_index_filepath(records_filepath)
+
+    def __len__(self):
+        return os.path.getsize(self.index_filepath) // INDEX_ENTRY.size
+
+    def __getitem__(self, chunk_index):
+        if chunk_index < 0:
+            chunk_index += len(self)
+        if not 0 <= chunk_index < len(self):
+            raise IndexError(f"No chunk {chunk_index} in {self.records_filepath}")
+        with open(self.index_filepath, "rb") as index_file:
+            index_file.seek(chunk_index * INDEX_ENTRY.size)
+            offset, = INDEX_ENTRY.unpack(index_file.read(INDEX_ENTRY.size))
+        with open(self.records_filepath, "rb") as records_file:
+            records_file.seek(offset)
+            return json.loads(records_file.readline())
+
+    def __iter__(self):
+        # only yield indexed records (at their indexed offsets), a record without index entry may be incomplete
+        record_count = len(self)
+        with open(self.index_filepath, "rb") as index_file, open(self.records_filepath, "rb") as records_file:
+            for _ in range(record_count):
+                offset, = INDEX_ENTRY.unpack(index_file.read(INDEX_ENTRY.size))
+                records_file.seek(offset)
+                yield json.loads(records_file.readline())
+
+    def texts(self):
+        return (record["text"] for record in self)
+
+
+# Function to convert a legacy *_long.txt dump (chunk texts separated by blank lines) into chunk records.
+# Empty chunks and chunks containing line breaks can not be recovered from that format.
+# PARAMS:
+# long_filepath (string): path to the *_long.txt file
+# records_filepath (string): path of the record file to create
+# piece_length (int): distance between the start offsets of two successive chunks in seconds
+def convert_long_text(long_filepath, records_filepath, piece_length):
+    with open(long_filepath, "r", encoding="utf-8") as inFile, ChunkRecordWriter(records_filepath) as writer:
+        index = 0
+        for line in inFile:
+            line = line.strip()  # Remove leading/trailing whitespace
+            if line:  # Only append non-empty lines
+                writer.append(index, index * piece_length, line)
+                index += 1
@@ -0,0 +1,864 @@
+import os
+import time
+import zlib
+import itertools
+import queue
+import threading
+import traceback
+import dataclasses
+import subprocess
+
+import numpy as np
+import torch
+import torch.multiprocessing
+import torch.nn.functional as F
+import whisper
+from whisper.audio import SAMPLE_RATE, CHUNK_LENGTH, N_FFT, HOP_LENGTH, N_FRAMES, mel_filters
+from whisper.decoding import DecodingTask, DecodingResult, LogitFilter
+from whisper.tokenizer import get_tokenizer
+from whisper.utils import compression_ratio
+
+import Tools
+
+# Define the time resolution of Whisper's timestamp tokens in seconds
+TIME_PRECISION = 0.02
+
+# Define how much audio to decode and drop before a window: after seeking, decoders of compressed formats (mp3, aac)
+# need a moment until their output is exactly the same as when decoding the file from its start
+SEEK_PREROLL_SECONDS = 1
+
+# Define when a partially decoded sequence counts as stuck in a repetition loop:
+# the last EARLY_STOP_NGRAM_SIZE tokens already occurred EARLY_STOP_NGRAM_REPEATS times in the sequence, or
+# the text compresses better than EARLY_STOP_COMPRESSION_RATIO (same measure as Whisper's own fallback in transcribe)
+EARLY_STOP_NGRAM_SIZE = 4
+EARLY_STOP_NGRAM_REPEATS = 4
+EARLY_STOP_COMPRESSION_RATIO = 2.4
+# the compression ratio is meaningless for short texts, so only check it once there are enough tokens and only every
+# few steps to keep the overhead low
+EARLY_STOP_MIN_TOKENS = 48
+EARLY_STOP_CHECK_INTERVAL = 8
+
+# Define how many seconds of the recording the log-Mel spectrogram is computed for at once (see iterate_recording_mels)
+MEL_BLOCK_SECONDS = 600
+# Define how many frames of audio to load beyond the borders of every block: frames use N_FFT // 2 samples on each side
+MEL_MARGIN_FRAMES = -(-(N_FFT // 2) // HOP_LENGTH)
+# Define the unnormalized log-Mel value of silence (the zero padding of pad_or_trim)
+SILENCE_LOG_MEL = -10.0
+# Define the log10 of the mean Mel power of a frame of full scale audio (a sine wave at 1 kHz with an RMS of 1), the
+# reference of the loudness in dB used by gate_silent_chunks (the same for 80 and 128 Mel bins)
+FULL_SCALE_LOG_MEL_POWER = 1.0
+
+# Define how many chunks may wait between the stages of the encoder/decoder pipeline (see EncoderPipeline) and how many
+# threads each stage may use (None to split the cores of the host evenly)
+PIPELINE_QUEUE_SIZE = 2
+PIPELINE_ENCODER_THREADS = None
+PIPELINE_DECODER_THREADS = None
+
+# Define how many tokens the draft model proposes before the large model verifies them in speculative decoding
+SPECULATIVE_DRAFT_LENGTH = 6
+
+# Define how many seconds of the recording model.transcribe gets at once in iterate_block_transcription
+TRANSCRIBE_BLOCK_SECONDS = 1800
+# Define how many previous segments are passed on as prompt to the next block
+TRANSCRIBE_PROMPT_SEGMENTS = 5
+
+
+# Logit filter that watches every partially decoded sequence and forces the end-of-text token as soon as the
+# sequence falls into a repetition loop, instead of letting the decoder generate until the token limit. Sequences are
+# only told apart by their tokens, since beam search reorders and replaces the rows of the batch at every step.
+class RepetitionStopFilter(LogitFilter):
+    def __init__(self, tokenizer, sample_begin):
+        self.tokenizer = tokenizer
+        self.sample_begin = sample_begin
+        # sampled tokens (without the end-of-text token) of the sequences that were stopped early
+        self.truncated = set()
+
+    # whether decoding of the sequence with the given sampled tokens (as in DecodingResult.tokens) was stopped early
+    def was_truncated(self, tokens):
+        return tuple(tokens) in self.truncated
+
+    def is_looping(self, sequence):
+        # timestamp tokens change with every repetition, so only compare text tokens
+        sequence = [token for token in sequence if token < self.tokenizer.timestamp_begin]
+        if len(sequence) >= EARLY_STOP_NGRAM_SIZE * EARLY_STOP_NGRAM_REPEATS:
+            last_ngram = sequence[-EARLY_STOP_NGRAM_SIZE:]
+            occurrences = sum(1 for i in range(len(sequence) - EARLY_STOP_NGRAM_SIZE + 1)
+                              if sequence[i:i + EARLY_STOP_NGRAM_SIZE] == last_ngram)
+            if occurrences >= EARLY_STOP_NGRAM_REPEATS:
+                return True
+        if len(sequence) >= EARLY_STOP_MIN_TOKENS and len(sequence) % EARLY_STOP_CHECK_INTERVAL == 0:
+            text_bytes = self.tokenizer.decode(sequence).encode("utf-8")
+            if len(text_bytes) / len(zlib.compress(text_bytes)) > EARLY_STOP_COMPRESSION_RATIO:
+                return True
+        return False
+
+    def apply(self, logits, tokens):
+        for i, sequence in enumerate(tokens[:, self.sample_begin:].tolist()):
+            # sequences that already ended only get further end-of-text tokens appended
+            if sequence and sequence[-1] == self.tokenizer.eot:
+                continue
+            if self.is_looping(sequence):
+                logits[i, :] = -float("inf")
+                logits[i, self.tokenizer.eot] = 0
+                self.truncated.add(tuple(sequence))
+
+
+# Function to decode like whisper.decode, but with sequences that fall into a repetition loop stopped early
+# PARAMS:
+# model (Whisper): loaded Whisper model
+# mel (Tensor): log-Mel spectrogram of shape (n_mels, 3000) or a batch of shape (n, n_mels, 3000)
+# options (DecodingOptions): options passed on to Whisper's decoding
+# RETURNS: Tuple of the DecodingResult (or list of them for a batch) and whether it was stopped early (or list of them)
+def decode_with_early_stop(model, mel, options):
+    single = mel.ndim == 2
+    if single:
+        mel = mel.unsqueeze(0)
+
+    task = DecodingTask(model, options)
+    stop_filter = RepetitionStopFilter(task.tokenizer, task.sample_begin)
+    task.logit_filters.append(stop_filter)
+    results = task.run(mel)
+
+    # only the returned sequence counts, not other beams or samples that were stopped early
+    truncated = [stop_filter.was_truncated(result.tokens) for result in results]
+    return (results[0], truncated[0]) if single else (results, truncated)
+
+
+# Function to run only the first step of Whisper's decoding, which already gives the probability of the audio not
+# containing speech (the same value as DecodingResult.no_speech_prob after decoding everything)
+# PARAMS:
+# model (Whisper): loaded Whisper model
+# mel (Tensor): log-Mel spectrogram of shape (n_mels, 3000) or audio features of shape (n_audio_ctx, n_audio_state)
+# options (DecodingOptions): options passed on to Whisper's decoding
+# RETURNS: Tuple of the audio features (to decode the chunk without encoding it again) and the no-speech probability
+def get_no_speech_probability(model, mel, options):
+    task = DecodingTask(model, options)
+    audio_features = task._get_audio_features(mel.unsqueeze(0))
+    if task.tokenizer.no_speech is None:
+        return audio_features[0], 0.0
+    # the logits at the start-of-transcript token only depend on the tokens up to it, not on the language token
+    tokens = torch.tensor([task.initial_tokens]).to(audio_features.device)
+    with torch.no_grad():
+        logits = model.logits(tokens, audio_features)
+    probs = logits[0, task.sot_index].float().softmax(dim=-1)
+    return audio_features[0], probs[task.tokenizer.no_speech].item()
+
+
+# Class to run a Whisper text decoder over new tokens only, keeping the keys and values of all previous positions.
+# Unlike Whisper's own kv cache it can process several new tokens at once (each attending to all cached positions
+# and the new positions before it) and it can be truncated to drop positions of rejected tokens.
+class CachedDecoder:
+    def __init__(self, decoder, audio_features):
+        self.decoder = decoder
+        self.device = decoder.token_embedding.weight.device
+        audio_features = audio_features.to(self.device)
+        self.dtype = audio_features.dtype
+        # keys and values of the audio features are the same for every position
+        self.cross_cache = [(block.cross_attn.key(audio_features), block.cross_attn.value(audio_features))
+                            for block in decoder.blocks]
+        self.cache = [None] * len(decoder.blocks)
+        self.length = 0
+
+    @staticmethod
+    def _attention(attention, q, k, v, mask=None):
+        q, k, v = (x.view(*x.shape[:2], attention.n_head, -1).permute(0, 2, 1, 3) for x in (q, k, v))
+        output = F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+        return attention.out(output.permute(0, 2, 1, 3).flatten(start_dim=2))
+
+    # Function to feed new tokens (list of int) following the cached positions
+    # RETURNS: logits of shape (number of new tokens, n_vocab)
+    def forward(self, tokens):
+        offset = self.length
+        tokens = torch.tensor([tokens], device=self.device)
+        x = self.decoder.token_embedding(tokens) + self.decoder.positional_embedding[offset:offset + tokens.shape[-1]]
+        x = x.to(self.dtype)
+        # new position i may attend to all cached positions and to the new positions up to i
+        mask = (torch.arange(offset + tokens.shape[-1], device=self.device)[None, :]
+                <= offset + torch.arange(tokens.shape[-1], device=self.device)[:, None])
+
+        for i, block in enumerate(self.decoder.blocks):
+            h = block.attn_ln(x)
+            k, v = block.attn.key(h), block.attn.value(h)
+            if self.cache[i] is not None:
+                k, v = torch.cat([self.cache[i][0], k], dim=1), torch.cat([self.cache[i][1], v], dim=1)
+            self.cache[i] = (k, v)
+            x = x + self._attention(block.attn, block.attn.query(h), k, v, mask)
+            h = block.cross_attn_ln(x)
+            x = x + self._attention(block.cross_attn, block.cross_attn.query(h), *self.cross_cache[i])
+            x = x + block.mlp(block.mlp_ln(x))
+
+        x = self.decoder.ln(x)
+        self.length += tokens.shape[-1]
+        return (x @ torch.transpose(self.decoder.token_embedding.weight.to(x.dtype), 0, 1)).float()[0]
+
+    # Function to forget all positions from length on
+    def truncate(self, length):
+        self.cache = [(k[:, :length], v[:, :length]) for k, v in self.cache]
+        self.length = min(self.length, length)
+
+
+# Function to translate a token between the vocabularies of two tokenizers. Text tokens are the same in all
+# multilingual models, special tokens (like timestamps) are looked up by name as their IDs depend on the number of
+# languages.
+# RETURNS: token ID in the target vocabulary or None if the token has no counterpart
+def map_token(token, source_tokenizer, target_tokenizer):
+    if token < source_tokenizer.eot:
+        return token
+    return target_tokenizer.special_tokens.get(source_tokenizer.encoding.decode([token]))
+
+
+# Function to decode a single segment greedily with the model, using a small draft model to speed it up.
+# The draft model proposes up to draft_length tokens one by one, the model scores all of them in one decoder pass and
+# keeps the proposals up to the first one that differs from its own greedy choice, plus that choice. All logit
+# filters of Whisper's decoding are applied to the model's logits at every position, so the result is identical to
+# model.decode(mel, options) with greedy decoding (up to floating point differences between the attention kernels).
+# PARAMS:
+# model (Whisper): model whose greedy transcription is reproduced
+# draft_model (Whisper): smaller model with a vocabulary of the same kind (multilingual or English-only)
+# mel (Tensor): log-Mel spectrogram of shape (n_mels, 3000) for the model
+# options (DecodingOptions): greedy decoding options (temperature 0, no beam search or best-of sampling)
+# draft_mel (Tensor): log-Mel spectrogram for the draft model if it uses a different number of Mel bins
+# draft_length (int): maximum number of tokens proposed at once
+# stop_repetition_loops (bool): whether to stop decoding early when it falls into a repetition loop
+# RETURNS: Tuple of the DecodingResult and a dictionary of statistics: proposed and accepted draft tokens, decoded
+# tokens, decoder passes of the model and whether the decoding was stopped early
+@torch.no_grad()
+def decode_speculative(model, draft_model, mel, options, draft_mel=None, draft_length=SPECULATIVE_DRAFT_LENGTH,
+                       stop_repetition_loops=False):
+    if options.temperature > 0 or options.beam_size is not None or options.best_of is not None:
+        raise ValueError("Speculative decoding only reproduces greedy decoding")
+    if model.is_multilingual != draft_model.is_multilingual:
+        raise ValueError("The draft model has to use the same kind of vocabulary as the model")
+    if draft_mel is None:
+        draft_mel = mel
+
+    task = DecodingTask(model, options)
+    stop_filter = None
+    if stop_repetition_loops:
+        stop_filter = RepetitionStopFilter(task.tokenizer, task.sample_begin)
+        task.logit_filters.append(stop_filter)
+    audio_features = task._get_audio_features(mel.unsqueeze(0))
+    tokens = torch.tensor([task.initial_tokens]).to(audio_features.device)
+    languages, _ = task._detect_language(audio_features, tokens)
+    tokens = tokens[0].tolist()
+
+    # the draft model continues the same prompt in the same language, in its own vocabulary
+    draft_task = DecodingTask(draft_model, dataclasses.replace(options, language=languages[0]))
+    draft_tokens = list(draft_task.initial_tokens)
+    target = CachedDecoder(model.decoder, audio_features)
+    draft = CachedDecoder(draft_model.decoder, draft_task._get_audio_features(draft_mel.unsqueeze(0)))
+
+    eot = task.tokenizer.eot
+    statistics = {"proposed": 0, "accepted": 0, "tokens": 0, "passes": 0}
+    sum_logprob = 0.0
+    no_speech_prob = np.nan
+    drafting = True
+    finished = False
+    while not finished:
+        # let the draft model propose tokens greedily (without exceeding the sample length or the context)
+        proposals = []
+        proposal_count = min(draft_length, task.sample_len - statistics["tokens"] - 1, task.n_ctx - len(tokens),
+                             draft_model.dims.n_text_ctx - len(draft_tokens)) if drafting else 0
+        while len(proposals) < proposal_count:
+            logits = draft.forward(draft_tokens[draft.length:])[-1:]
+            for logit_filter in draft_task.logit_filters:
+                logit_filter.apply(logits, torch.tensor([draft_tokens], device=logits.device))
+            draft_token = int(logits.argmax(dim=-1))
+            proposal = map_token(draft_token, draft_task.tokenizer, task.tokenizer)
+            if proposal is None:
+                break
+            proposals.append(proposal)
+            draft_tokens.append(draft_token)
+            if proposal == eot:
+                break
+        statistics["proposed"] += len(proposals)
+
+        # score the last accepted token and all proposals in one pass of the model
+        context_length = len(tokens)
+        logits = target.forward(tokens[target.length:] + proposals)
+        if statistics["passes"] == 0 and task.tokenizer.no_speech is not None:
+            no_speech_prob = logits[task.sot_index].softmax(dim=-1)[task.tokenizer.no_speech].item()
+        statistics["passes"] += 1
+        logits = logits[len(logits) - len(proposals) - 1:]
+
+        accepted = 0
+        for i in range(len(proposals) + 1):
+            position_logits = logits[i:i + 1].clone()
+            for logit_filter in task.logit_filters:
+                logit_filter.apply(position_logits, torch.tensor([tokens], device=position_logits.device))
+            next_token = int(position_logits.argmax(dim=-1))
+            sum_logprob += F.log_softmax(position_logits, dim=-1)[0, next_token].item()
+            tokens.append(next_token)
+            statistics["tokens"] += 1
+            if next_token == eot or statistics["tokens"] >= task.sample_len or len(tokens) > task.n_ctx:
+                finished = True
+                break
+            if i == len(proposals) or next_token != proposals[i]:
+                break
+            accepted += 1
+        statistics["accepted"] += accepted
+
+        # forget the positions of rejected proposals in both decoders
+        target.truncate(len(tokens) - 1)
+        draft_tokens = draft_tokens[:len(draft_tokens) - len(proposals) + accepted]
+        draft.truncate(len(draft_tokens))
+        draft_token = map_token(tokens[-1], task.tokenizer, draft_task.tokenizer)
+        if draft_token is None:
+            drafting = False
+        else:
+            draft_tokens.append(draft_token)
+
+    # same as Whisper's decoding: slice between the first sampled token and the end-of-text token
+    tokens = tokens[task.sample_begin:]
+    if eot in tokens:
+        tokens = tokens[:tokens.index(eot)]
+    text = task.tokenizer.decode(tokens).strip()
+    statistics["truncated"] = bool(stop_filter and stop_filter.was_truncated(tokens))
+    result = DecodingResult(audio_features=audio_features[0], language=languages[0], tokens=tokens, text=text,
+                            avg_logprob=sum_logprob / (len(tokens) + 1), no_speech_prob=no_speech_prob,
+                            temperature=options.temperature, compression_ratio=compression_ratio(text))
+    return result, statistics
+
+
+# Function to compute the log-Mel spectrogram like whisper.log_mel_spectrogram, but without its normalization, which
+# depends on the maximum of the 30 second window (see normalize_log_mel). The magnitudes of the STFT are shared by all
+# requested numbers of Mel bins.
+# PARAMS:
+# audio (numpy array or Tensor): waveform at Whisper's sample rate
+# n_mels_list (tuple of int): numbers of Mel bins to compute spectrograms for (80 and/or 128)
+# RETURNS: Tuple of Tensors of shape (n_mels, len(audio) // HOP_LENGTH), one per entry of n_mels_list
+def compute_log_mel(audio, n_mels_list):
+    audio = torch.as_tensor(audio)
+    stft = torch.stft(audio, N_FFT, HOP_LENGTH, window=torch.hann_window(N_FFT).to(audio.device), return_complex=True)
+    # square the magnitudes in place before dropping the last frame (same values, but no copy of the strided slice)
+    magnitudes = stft.abs().pow_(2)[..., :-1]
+    return tuple(torch.clamp(mel_filters(audio.device, n_mels) @ magnitudes, min=1e-10).log10()
+                 for n_mels in n_mels_list)
+
+
+# Function to apply Whisper's normalization to the log-Mel spectrogram of a 30 second window
+def normalize_log_mel(log_spec):
+    log_spec = torch.maximum(log_spec, log_spec.max() - 8.0)
+    return (log_spec + 4.0) / 4.0
+
+
+# Function to cut the window of a chunk out of the log-Mel spectrogram of a longer piece of the recording.
+# The window is padded to N_FRAMES with the value of silence (like pad_or_trim does on the waveform) and normalized.
+# PARAMS:
+# log_spec (Tensor): unnormalized log-Mel spectrogram (see compute_log_mel)
+# start_frame (int): first frame of the chunk in log_spec
+# frame_count (int): number of frames of the chunk
+# RETURNS: Tensor of shape (n_mels, N_FRAMES)
+def slice_chunk_mel(log_spec, start_frame, frame_count):
+    window = log_spec[:, start_frame:start_frame + min(frame_count, N_FRAMES)]
+    window = F.pad(window, (0, N_FRAMES - window.shape[-1]), value=SILENCE_LOG_MEL)
+    return normalize_log_mel(window)
+
+
+# Function to compute the loudness of the loudest frame of a chunk in dB relative to full scale from its log-Mel
+# spectrogram (Whisper's normalization keeps the absolute level of all but the quietest bins)
+def get_peak_loudness(mel):
+    frame_power = torch.pow(10, mel.float() * 4 - 4).mean(dim=0)
+    return 10 * (frame_power.max().log10().item() - FULL_SCALE_LOG_MEL_POWER)
+
+
+# Function to replace the spectrograms of chunks whose loudest frame is quieter than threshold_db by an empty tuple,
+# so neither the encoder nor the decoder runs for them (see decode_chunk_mels)
+# RETURNS: Generator of the tuples of chunk_mels or empty tuples
+def gate_silent_chunks(chunk_mels, threshold_db):
+    for mels in chunk_mels:
+        yield mels if get_peak_loudness(mels[0]) >= threshold_db else ()
+
+
+# Function to compute the log-Mel spectrograms of the chunk files one by one (see Tools.process_file)
+# RETURNS: Generator of tuples of Tensors of shape (n_mels, N_FRAMES), one per entry of n_mels_list
+def iterate_chunk_file_mels(audio_chunks_paths, n_mels_list):
+    for audio_path in audio_chunks_paths:
+        audio = whisper.pad_or_trim(whisper.load_audio(audio_path))
+        yield tuple(whisper.log_mel_spectrogram(audio, n_mels=n_mels) for n_mels in n_mels_list)
+
+
+# Function to compute the log-Mel spectrograms of the same chunks as Tools.process_file, but from the recording itself.
+# The spectrogram is computed for blocks of block_seconds of the recording in one pass and every chunk's window is a
+# slice of it, so overlapping audio and the padding are not transformed twice (or at all) and no chunk files are
+# needed. Every block is loaded with a margin of MEL_MARGIN_FRAMES frames, so the frames at its borders are the same
+# as in a spectrogram of the whole recording.
+# PARAMS:
+# filepath (string): path of the audio or video file
+# duration (float): length of the recording in seconds
+# n_mels_list (tuple of int): numbers of Mel bins to compute spectrograms for (80 and/or 128)
+# block_seconds (float): length of recording to compute the spectrogram for at once (bounds the memory usage)
+# job (Tools.TranscriptionJob): chunking parameters
+# RETURNS: Generator of tuples of Tensors of shape (n_mels, N_FRAMES), one per entry of n_mels_list
+def iterate_recording_mels(filepath, duration, n_mels_list, block_seconds=MEL_BLOCK_SECONDS, job=None):
+    job = job or Tools.TranscriptionJob()
+    frames_per_second = SAMPLE_RATE // HOP_LENGTH
+    piece_frames = job.piece_length * frames_per_second
+    chunk_frames = job.chunk_length() * frames_per_second
+    chunk_count = Tools.get_piece_count(duration, job)
+    chunks_per_block = max(1, int(block_seconds // job.piece_length))
+
+    for first_chunk in range(0, chunk_count, chunks_per_block):
+        last_chunk = min(first_chunk + chunks_per_block, chunk_count) - 1
+        first_frame = first_chunk * piece_frames
+        end_frame = last_chunk * piece_frames + chunk_frames
+        # there is no audio to the left of the recording's start (the STFT reflects the signal there instead)
+        left_margin = min(MEL_MARGIN_FRAMES, first_frame)
+        audio = load_audio_window(filepath, (first_frame - left_margin) / frames_per_second,
+                                  (end_frame - first_frame + left_margin + MEL_MARGIN_FRAMES) / frames_per_second)
+        log_specs = [log_spec[:, left_margin:] for log_spec in compute_log_mel(audio, n_mels_list)]
+
+        for idx in range(first_chunk, last_chunk + 1):
+            start_frame = (idx - first_chunk) * piece_frames
+            yield tuple(slice_chunk_mel(log_spec, start_frame, chunk_frames) for log_spec in log_specs)
+
+
+# Function to decode a single chunk with the model, the draft model or stopping repetition loops
+# RETURNS: Tuple of the DecodingResult and whether decoding was stopped early
+def _decode_chunk(model, mel, mels, options, stop_repetition_loops, draft_model, speculative_statistics):
+    if draft_model is not None:
+        result, statistics = decode_speculative(model, draft_model, mel, options, mels[1].to(draft_model.device),
+                                                stop_repetition_loops=stop_repetition_loops)
+        for key in speculative_statistics:
+            speculative_statistics[key] += statistics[key]
+        return result, statistics["truncated"]
+    if stop_repetition_loops:
+        return decode_with_early_stop(model, mel, options)
+    return model.decode(mel, options), False
+
+
+# Function to decode the log-Mel spectrograms of all chunks one after another.
+# The model is only used through its detect_language and decode methods and its dims, device, is_multilingual and
+# num_languages attributes, so any object providing those can stand in for a Whisper model
+# (see Benchmark.StubWhisperModel).
+# PARAMS:
+# model (Whisper): loaded Whisper model
+# chunk_mels (iterable of tuples of Tensor): log-Mel spectrogram of every chunk for the model (and the draft model),
+# silent chunks as empty tuples (see gate_silent_chunks)
+# chunk_count (int): number of chunks
+# progress_queue (Queue): queue to feed current progress values to GUI refresh function
+# stop_repetition_loops (bool): whether to stop decoding a chunk early when it falls into a repetition loop
+# record_writer (ChunkRecordWriter): if not None, every chunk's result is appended to it as soon as it is decoded
+# decoding_options (dict): additional DecodingOptions (e.g. beam_size) as chosen by Scheduling.choose_model
+# draft_model (Whisper): if not None, every chunk is decoded speculatively with this draft model (greedy only)
+# job (Tools.TranscriptionJob): chunking parameters (the piece length gives the start of every chunk). If it skips
+# chunks without speech, chunks with a no-speech probability above its threshold after the first decoder step get an
+# empty result, and the skipped chunks are stored in job.skipped_chunks
+# RETURNS: Tuple of list of DecodingResult (one per chunk, empty for jobs with bounded memory, read the chunk records
+# instead), tokenizer for the detected language,
+# list of indices of chunks stopped early and list of decoding durations per chunk in seconds
+def decode_chunk_mels(model, chunk_mels, chunk_count, progress_queue, stop_repetition_loops=False,
+                      record_writer=None, decoding_options=None, draft_model=None, job=None):
+    job = job or Tools.TranscriptionJob()
+    if job.bounded_memory:
+        Tools.bound_heap_growth()
+    start_time = time.time()
+    speculative_statistics = {"proposed": 0, "accepted": 0, "tokens": 0, "passes": 0}
+    results = []
+    tokenizer = None
+    language = None
+    # indices and decoding durations of chunks that were stopped early because of a repetition loop
+    truncated_chunks = []
+    decoding_durations = []
+    job.skipped_chunks = []
+
+    for idx, mels in enumerate(chunk_mels):
+        options = whisper.DecodingOptions(fp16=False, **(decoding_options or {}))
+        decoding_start_time = time.time()
+        # silent chunks come without spectrograms (see gate_silent_chunks)
+        skip_reason = None if mels else "silence"
+        no_speech_prob = np.nan
+        if mels:
+            # move the log-Mel spectrogram to the same device as the model
+            mel = mels[0].to(model.device)
+            if job.skip_no_speech:
+                # continue with the audio features, so the chunk is not encoded again
+                mel, no_speech_prob = get_no_speech_probability(model, mel, options)
+                if no_speech_prob > job.no_speech_threshold:
+                    skip_reason = "no speech"
+
+        if skip_reason is not None:
+            job.skipped_chunks.append((idx, skip_reason))
+            result = DecodingResult(audio_features=None, language=language, no_speech_prob=no_speech_prob)
+        else:
+            if tokenizer is None:
+                # detect the spoken language on the first chunk with speech (not counted as decoding time)
+                detection_start_time = time.time()
+                _, probs = model.detect_language(mel)
+                language = max(probs, key=probs.get)
+                print(f"Detected language: {language}")
+                tokenizer = get_tokenizer(model.is_multilingual, num_languages=model.num_languages,
+                                          language=language, task="transcribe")
+                decoding_start_time += time.time() - detection_start_time
+            result, truncated = _decode_chunk(model, mel, mels, options, stop_repetition_loops, draft_model,
+                                              speculative_statistics)
+            if truncated:
+                truncated_chunks.append(idx)
+                print(f"Stopped repetition loop in chunk {idx}")
+        decoding_durations.append(time.time() - decoding_start_time)
+        # drop the encoder output every DecodingResult holds (n_audio_ctx x n_audio_state values per chunk)
+        result = dataclasses.replace(result, audio_features=None)
+        if not job.bounded_memory:
+            results.append(result)
+        if record_writer is not None:
+            record_writer.append_result(idx, idx * job.piece_length, result)
+        elapsed_time = time.time() - start_time
+        elapsed_minutes = int(elapsed_time // 60)
+        elapsed_seconds = int(elapsed_time % 60)
+        print(f"{idx + 1}/{chunk_count} - t.e. {elapsed_minutes:02d}:{elapsed_seconds:02d}")
+
+        progress_queue.put(idx + 1)  # Update the progress queue
+
+    if tokenizer is None:
+        # no chunk contained speech
+        tokenizer = get_tokenizer(model.is_multilingual, num_languages=model.num_languages, task="transcribe")
+    if job.skip_no_speech:
+        silent_count = sum(1 for _, reason in job.skipped_chunks if reason == "silence")
+        print(f"Skipped {len(job.skipped_chunks)}/{chunk_count} chunks without speech ({silent_count} silent, "
+              f"{len(job.skipped_chunks) - silent_count} by no-speech probability).")
+    if draft_model is not None and speculative_statistics["passes"]:
+        print(f"Speculative decoding: accepted {speculative_statistics['accepted']}/"
+              f"{speculative_statistics['proposed']} draft tokens, "
+              f"{speculative_statistics['tokens'] / speculative_statistics['passes']:.2f} tokens per decoder pass.")
+    return results, tokenizer, truncated_chunks, decoding_durations
+
+
+# Function run in the encoder process of EncoderPipeline: encodes the spectrograms of every chunk (for the model and
+# the draft model) and passes the audio features on, followed by the times the stage was busy and waiting
+def _run_encoder_stage(encoders, threads, input_queue, output_queue):
+    torch.set_num_threads(threads)
+    statistics = {"encoder_busy": 0.0, "encoder_input_wait": 0.0, "encoder_output_wait": 0.0}
+    try:
+        with torch.no_grad():
+            while True:
+                wait_start_time = time.perf_counter()
+                mels = input_queue.get()
+                encode_start_time = time.perf_counter()
+                statistics["encoder_input_wait"] += encode_start_time - wait_start_time
+                if mels is None:
+                    break
+                features = tuple(encoder(torch.from_numpy(mel).unsqueeze(0))[0].numpy()
+                                 for encoder, mel in zip(encoders, mels))
+                put_start_time = time.perf_counter()
+                statistics["encoder_busy"] += put_start_time - encode_start_time
+                output_queue.put(("features", features))
+                statistics["encoder_output_wait"] += time.perf_counter() - put_start_time
+        output_queue.put(("done", statistics))
+    except Exception:
+        output_queue.put(("error", traceback.format_exc()))
+
+
+# Class to run the audio encoder and the text decoder as two pipeline stages on a CPU host: while the decoder decodes
+# chunk i (in the calling process), an encoder process already encodes chunk i + 1. Each stage runs with its own
+# thread budget (PyTorch's thread count can only be set per process), the stages are connected by queues of
+# queue_size chunks. Spectrograms and features are passed as numpy arrays, so they don't depend on the lifetime of
+# the sending process. Iterating yields the audio features of every chunk, which Whisper's decoding (and
+# decode_chunk_mels) accepts in place of the spectrograms. The spectrograms are computed by a thread of the calling
+# process. After the iteration, report() prints how busy each stage was.
+class EncoderPipeline:
+    def __init__(self, model, chunk_mels, draft_model=None, encoder_threads=None, decoder_threads=None,
+                 queue_size=PIPELINE_QUEUE_SIZE):
+        cores = os.cpu_count() or 1
+        self.encoder_threads = encoder_threads or PIPELINE_ENCODER_THREADS or max(1, cores // 2)
+        self.decoder_threads = decoder_threads or PIPELINE_DECODER_THREADS or max(1, cores - self.encoder_threads)
+        self.encoders = [model.encoder] + ([draft_model.encoder] if draft_model is not None else [])
+        self.chunk_mels = chunk_mels
+        self.queue_size = queue_size
+        self.statistics = {}
+        # exception raised while computing the spectrograms (the feeder thread ends the encoder stage instead)
+        self.feed_exception = None
+
+    def _feed(self, input_queue, stop_event):
+        spectrogram_time = 0.0
+        chunk_mels = iter(self.chunk_mels)
+        while not stop_event.is_set():
+            start_time = time.perf_counter()
+            try:
+                mels = next(chunk_mels, None)
+                if mels is not None:
+                    mels = tuple(mel.cpu().numpy() for mel in mels)
+            except Exception as exception:
+                # end the encoder stage as usual, the exception is raised again by __iter__
+                self.feed_exception = exception
+                mels = None
+            spectrogram_time += time.perf_counter() - start_time
+            # the end of the chunks (None) is passed on as well
+            while not stop_event.is_set():
+                try:
+                    input_queue.put(mels, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if mels is None:
+                break
+        self.statistics["spectrograms"] = spectrogram_time
+
+    def __iter__(self):
+        context = torch.multiprocessing.get_context("spawn")
+        input_queue = context.Queue(self.queue_size)
+        output_queue = context.Queue(self.queue_size)
+        for encoder in self.encoders:
+            encoder.share_memory()
+        process = context.Process(target=_run_encoder_stage, daemon=True,
+                                  args=(self.encoders, self.encoder_threads, input_queue, output_queue))
+        process.start()
+        stop_event = threading.Event()
+        self.feed_exception = None
+        threading.Thread(target=self._feed, args=(input_queue, stop_event), daemon=True).start()
+
+        previous_threads = torch.get_num_threads()
+        torch.set_num_threads(self.decoder_threads)
+        start_time = time.perf_counter()
+        decoder_wait = 0.0
+        try:
+            while True:
+                wait_start_time = time.perf_counter()
+                while True:
+                    try:
+                        kind, value = output_queue.get(timeout=1)
+                        break
+                    except queue.Empty:
+                        if not process.is_alive():
+                            raise RuntimeError(f"Encoder process exited with code {process.exitcode}")
+                decoder_wait += time.perf_counter() - wait_start_time
+                if "startup" not in self.statistics:
+                    self.statistics["startup"] = time.perf_counter() - start_time
+                if kind == "error":
+                    raise RuntimeError(f"Encoder process failed:\n{value}")
+                if kind == "done":
+                    self.statistics.update(value)
+                    if self.feed_exception is not None:
+                        raise self.feed_exception
+                    break
+                yield tuple(torch.from_numpy(features) for features in value)
+        finally:
+            stop_event.set()
+            torch.set_num_threads(previous_threads)
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+            self.statistics["wall"] = time.perf_counter() - start_time
+            self.statistics["decoder_wait"] = decoder_wait
+
+    # Function to print and return the utilization of the stages (share of the wall time they were busy)
+    def report(self):
+        wall_time = self.statistics["wall"]
+        utilization = {"encoder": self.statistics.get("encoder_busy", 0.0) / wall_time,
+                       "decoder": (wall_time - self.statistics["decoder_wait"]) / wall_time,
+                       "spectrograms": self.statistics.get("spectrograms", 0.0) / wall_time}
+        print(f"Pipeline ({self.encoder_threads} encoder, {self.decoder_threads} decoder threads, "
+              f"{self.statistics.get('startup', 0.0):.1f}s startup): encoder busy {utilization['encoder']:.0%}, "
+              f"decoder busy {utilization['decoder']:.0%}, spectrograms {utilization['spectrograms']:.0%} "
+              f"of {wall_time:.1f}s.")
+        return utilization
+
+
+def _get_n_mels_list(model, draft_model):
+    return (model.dims.n_mels,) if draft_model is None else (model.dims.n_mels, draft_model.dims.n_mels)
+
+
+# Function to decode the chunks, with the encoder running ahead in a pipeline stage of its own if requested and
+# without encoding silent chunks if the job skips chunks without speech
+def _decode_chunk_mels_pipelined(model, chunk_mels, chunk_count, progress_queue, stop_repetition_loops,
+                                 record_writer, decoding_options, draft_model, pipeline, job):
+    job = job or Tools.TranscriptionJob()
+    if job.skip_no_speech:
+        chunk_mels = gate_silent_chunks(chunk_mels, job.silence_threshold_db)
+    if not pipeline:
+        return decode_chunk_mels(model, chunk_mels, chunk_count, progress_queue, stop_repetition_loops,
+                                 record_writer, decoding_options, draft_model, job)
+    encoder_pipeline = EncoderPipeline(model, chunk_mels, draft_model)
+    results = decode_chunk_mels(model, encoder_pipeline, chunk_count, progress_queue, stop_repetition_loops,
+                                record_writer, decoding_options, draft_model, job)
+    encoder_pipeline.report()
+    return results
+
+
+# Function to transcribe audio chunks one after another (see decode_chunk_mels for the other parameters)
+# PARAMS:
+# audio_chunks_paths (list of string): filepaths to all audio chunks
+# pipeline (bool): whether to encode the next chunks in an EncoderPipeline while decoding (model on the CPU)
+def transcribe_chunks(model, audio_chunks_paths, progress_queue, stop_repetition_loops=False, record_writer=None,
+                      decoding_options=None, draft_model=None, pipeline=False, job=None):
+    chunk_mels = iterate_chunk_file_mels(audio_chunks_paths, _get_n_mels_list(model, draft_model))
+    return _decode_chunk_mels_pipelined(model, chunk_mels, len(audio_chunks_paths), progress_queue,
+                                        stop_repetition_loops, record_writer, decoding_options, draft_model, pipeline,
+                                        job)
+
+
+# Function to transcribe the same chunks as transcribe_chunks, but with their log-Mel spectrograms sliced out of the
+# spectrogram of the recording (no chunk files required, see iterate_recording_mels for the other parameters)
+def transcribe_recording(model, filepath, duration, progress_queue, stop_repetition_loops=False, record_writer=None,
+                         decoding_options=None, draft_model=None, block_seconds=MEL_BLOCK_SECONDS, pipeline=False,
+                         job=None):
+    job = job or Tools.TranscriptionJob()
+    chunk_mels = iterate_recording_mels(filepath, duration, _get_n_mels_list(model, draft_model), block_seconds, job)
+    return _decode_chunk_mels_pipelined(model, chunk_mels, Tools.get_piece_count(duration, job), progress_queue,
+                                        stop_repetition_loops, record_writer, decoding_options, draft_model, pipeline,
+                                        job)
+
+
+# Function to load a window of an audio file like whisper.load_audio, but only the requested part of it.
+# ffmpeg seeks on the input, so loading a window does not decode the file up to its start. The samples are the same
+# as those of whisper.load_audio, as SEEK_PREROLL_SECONDS before the window are decoded and dropped.
+# PARAMS:
+# filepath (string): path of the audio or video file
+# start (float): start of the window in seconds
+# duration (float): length of the window in seconds
+# RETURNS: numpy array of the mono waveform at Whisper's sample rate (shorter than duration at the end of the file)
+def load_audio_window(filepath, start, duration):
+    preroll = min(start, SEEK_PREROLL_SECONDS)
+    # only seek when required, seeking to the start drops the first frames of some mp3 files
+    seek = ["-ss", str(start - preroll)] if start - preroll > 0 else []
+    cmd = ["ffmpeg", "-nostdin", "-threads", "0", *seek, "-t", str(duration + preroll), "-i", filepath,
+           "-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le", "-ar", str(SAMPLE_RATE), "-"]
+    out = subprocess.run(cmd, capture_output=True, check=True).stdout
+    return np.frombuffer(out, np.int16).flatten().astype(np.float32)[round(preroll * SAMPLE_RATE):] / 32768.0
+
+
+# Function to split the tokens of a window decoded with timestamps into segments (same rules as whisper.transcribe).
+# Two timestamp tokens in a row end one segment and start the next one. If the window does not end with a single
+# timestamp, its last segment was cut off by the end of the window and is left for the next window.
+# PARAMS:
+# tokens (list of int): tokens of the DecodingResult
+# timestamp_begin (int): ID of the first timestamp token of the tokenizer
+# window_duration (float): length of the decoded audio in seconds
+# RETURNS: Tuple of a list of complete segments (start, end, text tokens) with times relative to the window and
+# the number of seconds to advance to the next window (end of the last complete segment)
+def split_timestamp_segments(tokens, timestamp_begin, window_duration):
+    is_timestamp = [token >= timestamp_begin for token in tokens]
+    single_timestamp_ending = is_timestamp[-2:] == [False, True]
+    consecutive = [i + 1 for i in range(len(tokens) - 1) if is_timestamp[i] and is_timestamp[i + 1]]
+
+    # no complete segment boundary: the whole window is one segment
+    if not consecutive:
+        timestamps = [token for token in tokens if token >= timestamp_begin]
+        end = (timestamps[-1] - timestamp_begin) * TIME_PRECISION if timestamps and timestamps[-1] != timestamp_begin \
+            else window_duration
+        text_tokens = [token for token in tokens if token < timestamp_begin]
+        return ([(0.0, end, text_tokens)] if text_tokens else []), window_duration
+
+    if single_timestamp_ending:
+        consecutive.append(len(tokens))
+    segments = []
+    last_slice = 0
+    for current_slice in consecutive:
+        sliced_tokens = tokens[last_slice:current_slice]
+        segments.append(((sliced_tokens[0] - timestamp_begin) * TIME_PRECISION,
+                         (sliced_tokens[-1] - timestamp_begin) * TIME_PRECISION,
+                         [token for token in sliced_tokens if token < timestamp_begin]))
+        last_slice = current_slice
+
+    # single timestamp at the end means no speech after the last timestamp
+    if single_timestamp_ending:
+        return segments, window_duration
+    # otherwise continue right after the last complete segment (at least one token step to always make progress)
+    return segments, max((tokens[last_slice - 1] - timestamp_begin) * TIME_PRECISION, TIME_PRECISION)
+
+
+# Function to transcribe a whole recording with a sliding window instead of fixed overlapping chunks.
+# Every window is decoded with timestamp tokens and the next window starts at the end of the last complete segment,
+# so no audio is decoded twice and the results don't need to be knitted.
+# PARAMS:
+# model (Whisper): loaded Whisper model
+# filepath (string): path of the audio or video file
+# duration (float): length of the recording in seconds
+# progress_queue (Queue): queue to feed current progress values (seconds transcribed) to GUI refresh function
+# decoding_options (dict): additional DecodingOptions (e.g. beam_size) as chosen by Scheduling.choose_model
+# RETURNS: Tuple of the transcription (string) with a time stamp before every window, the list of segments
+# (start, end, text) in seconds of the recording and the number of decoded windows
+def transcribe_sliding(model, filepath, duration, progress_queue, decoding_options=None):
+    start_time = time.time()
+    tokenizer = None
+    language = None
+    seek = 0.0
+    window_count = 0
+    segments = []
+    result_parts = []
+
+    while seek < duration:
+        audio = load_audio_window(filepath, seek, CHUNK_LENGTH)
+        if len(audio) == 0:
+            break
+        window_duration = len(audio) / SAMPLE_RATE
+        mel = whisper.log_mel_spectrogram(whisper.pad_or_trim(audio), n_mels=model.dims.n_mels).to(model.device)
+
+        if tokenizer is None:
+            # detect the spoken language on the first window
+            _, probs = model.detect_language(mel)
+            language = max(probs, key=probs.get)
+            print(f"Detected language: {language}")
+            tokenizer = get_tokenizer(model.is_multilingual, num_languages=model.num_languages,
+                                      language=language, task="transcribe")
+
+        # decode the audio with timestamp tokens
+        options = whisper.DecodingOptions(fp16=False, language=language, without_timestamps=False,
+                                          **(decoding_options or {}))
+        result = model.decode(mel, options)
+        window_count += 1
+
+        window_segments, advance = split_timestamp_segments(result.tokens, tokenizer.timestamp_begin,
+                                                            window_duration)
+        window_text = ""
+        for start, end, text_tokens in window_segments:
+            text = tokenizer.decode(text_tokens).strip()
+            segments.append((seek + start, seek + end, text))
+            window_text += " " + text if window_text and text else text
+        if window_text:
+            result_parts.append("[" + Tools.convert_to_duration(int(seek)) + "] " + window_text)
+
+        seek += advance
+        elapsed_time = time.time() - start_time
+        print(f"{min(seek, duration):.1f}/{duration:.1f}s - t.e. {int(elapsed_time // 60):02d}:"
+              f"{int(elapsed_time % 60):02d}")
+        progress_queue.put(int(min(seek, duration)))  # Update the progress queue
+
+    return " ".join(result_parts), segments, window_count
+
+
+# Function to transcribe a whole recording like model.transcribe, but in blocks of block_seconds, so neither the
+# waveform nor the log-Mel spectrogram of the whole recording is ever held in memory.
+# The last segment of a block may be cut off by the block's end, so segments ending within the last CHUNK_LENGTH
+# seconds of a block are dropped and the next block starts at the first dropped segment, with the last kept segments
+# as prompt (like condition_on_previous_text within a block). The block that ends before block_seconds is the last one,
+# the duration of the container (e.g. from ffprobe) may be slightly longer than the audio that actually decodes.
+# PARAMS:
+# model (Whisper): loaded Whisper model
+# filepath (string): path of the audio or video file
+# duration (float): length of the recording in seconds (only used to report the progress)
+# block_seconds (float): length of recording to transcribe at once (bounds the memory usage, more than 2 * CHUNK_LENGTH)
+# decoding_options (dict): additional options for model.transcribe (e.g. beam_size) as chosen by Scheduling.choose_model
+# RETURNS: Generator of segments (start, end, text) in seconds of the recording
+def iterate_block_transcription(model, filepath, duration, block_seconds=TRANSCRIBE_BLOCK_SECONDS,
+                                decoding_options=None):
+    decoding_options = dict(decoding_options or {})
+    seek = 0.0
+    prompt = None
+
+    while True:
+        audio = load_audio_window(filepath, seek, block_seconds)
+        if len(audio) == 0:
+            break
+        block_duration = len(audio) / SAMPLE_RATE
+        result = model.transcribe(audio, initial_prompt=prompt, **decoding_options)
+        # keep the language of the first block instead of detecting it for every block
+        decoding_options["language"] = result["language"]
+
+        segments = result["segments"]
+        kept = segments
+        advance = block_duration
+        last_block = len(audio) < round(block_seconds * SAMPLE_RATE)
+        if not last_block:
+            kept = list(itertools.takewhile(lambda segment: segment["end"] <= block_duration - CHUNK_LENGTH, segments))
+            dropped = segments[len(kept):]
+            advance = dropped[0]["start"] if dropped else max(block_duration - CHUNK_LENGTH,
+                                                               kept[-1]["end"] if kept else 0)
+        for segment in kept:
+            yield seek + segment["start"], seek + segment["end"], segment["text"].strip()
+        if kept:
+            prompt = " ".join(segment["text"].strip() for segment in kept[-TRANSCRIBE_PROMPT_SEGMENTS:])
+
+        seek += max(advance, TIME_PRECISION)
+        print(f"{min(seek, duration):.1f}/{duration:.1f}s transcribed")
+        if last_block:
+            break
@@ -0,0 +1,165 @@
+import os
+import sys
+import json
+import time
+import socket
+from queue import Queue
+
+# Define the Whisper model sizes to choose from (largest first) and their speed relative to the large models
+# (as published by OpenAI). Used to extrapolate real-time factors of models that were not measured on this machine.
+MODEL_SIZES = ["large-v3", "large-v2", "medium", "small", "base", "tiny"]
+RELATIVE_SPEED = {"large-v3": 1, "large-v2": 1, "medium": 2, "small": 4, "base": 7, "tiny": 10}
+
+# Define the decoding settings to choose from (more accurate first) and their cost relative to greedy decoding
+DECODING_SETTINGS = {"beam": {"beam_size": 5}, "greedy": {}}
+RELATIVE_COST = {"beam": 1.6, "greedy": 1}
+
+# Define the candidates in order of preference: the largest model first, for every model the more accurate setting
+CANDIDATES = [(model_name, settings_name) for model_name in MODEL_SIZES for settings_name in DECODING_SETTINGS]
+
+# Define the model used when no deadline is given or nothing has been measured yet
+DEFAULT_CANDIDATE = ("large-v3", "greedy")
+
+# Define the factor by which the expected duration has to undercut the deadline
+SAFETY_MARGIN = 1.2
+
+# Define where the measured real-time factors (processing seconds per recording second) of all machines are stored
+PROFILE_FILEPATH = "Transcription/model_rtf.json"
+
+
+# Function to get the mode the real-time factors of a run are stored and looked up under. Every option that changes
+# the speed of a mode gets profiles of its own, so choose_model only compares and extrapolates measurements that were
+# made with the same options.
+# PARAMS:
+# mode (string): transcription mode ("chunked", "sliding" or "whole")
+# options (dict): speed relevant options of the run, options set to False or None are left out
+# RETURNS: mode with all set options (string), e.g. "chunked+draft=tiny+pipeline"
+def get_profile_mode(mode, **options):
+    return "+".join([mode] + [name if value is True else f"{name}={value}"
+                              for name, value in sorted(options.items()) if value])
+
+
+def _profile_key(mode, model_name, settings_name):
+    return f"{mode}:{model_name}:{settings_name}"
+
+
+# Function to read the real-time factors measured on this machine
+# RETURNS: Dictionary of profile key (mode:model:settings) to real-time factor (float)
+def load_machine_profile():
+    if not os.path.exists(PROFILE_FILEPATH):
+        return {}
+    with open(PROFILE_FILEPATH, "r", encoding="utf-8") as inFile:
+        return json.load(inFile).get(socket.gethostname(), {})
+
+
+# Function to store a measured real-time factor for this machine. New measurements are blended into the stored value
+# (weight 1 replaces it), so the profile follows the machine's actual performance over many runs.
+# PARAMS:
+# mode (string): transcription mode ("chunked", "sliding" or "whole") with its options (see get_profile_mode)
+# model_name (string): Whisper model size
+# settings_name (string): key of DECODING_SETTINGS
+# real_time_factor (float): processing seconds per recording second
+# weight (float): weight of the new measurement
+def record_real_time_factor(mode, model_name, settings_name, real_time_factor, weight=0.3):
+    profiles = {}
+    if os.path.exists(PROFILE_FILEPATH):
+        with open(PROFILE_FILEPATH, "r", encoding="utf-8") as inFile:
+            profiles = json.load(inFile)
+    profile = profiles.setdefault(socket.gethostname(), {})
+    key = _profile_key(mode, model_name, settings_name)
+    previous = profile.get(key)
+    profile[key] = real_time_factor if previous is None else (1 - weight) * previous + weight * real_time_factor
+    with open(PROFILE_FILEPATH, "w", encoding="utf-8") as outFile:
+        json.dump(profiles, outFile, indent=2)
+
+
+# Function to estimate the real-time factor of a candidate on this machine: the measured value if there is one,
+# otherwise the average extrapolation from all measured candidates of the same mode
+# RETURNS: real-time factor (float) or None if nothing has been measured for the mode
+def estimate_real_time_factor(profile, mode, model_name, settings_name):
+    measured = profile.get(_profile_key(mode, model_name, settings_name))
+    if measured is not None:
+        return measured
+    extrapolations = [profile[_profile_key(mode, other_model, other_settings)]
+                      * RELATIVE_SPEED[other_model] / RELATIVE_SPEED[model_name]
+                      * RELATIVE_COST[settings_name] / RELATIVE_COST[other_settings]
+                      for other_model, other_settings in CANDIDATES
+                      if _profile_key(mode, other_model, other_settings) in profile]
+    return sum(extrapolations) / len(extrapolations) if extrapolations else None
+
+
+# Function to choose the largest model and most accurate decoding settings that are expected to finish in time
+# PARAMS:
+# audio_length (float): length of the recording in seconds
+# deadline (float): time available for the transcription in seconds
+# mode (string): transcription mode the real-time factors were measured for
+# settings_names (list of string): keys of DECODING_SETTINGS the mode supports (all if None), e.g. only "greedy" for
+# speculative decoding
+# RETURNS: Dictionary describing the decision (to be stored as job metadata, see write_job_metadata)
+def choose_model(audio_length, deadline, mode="chunked", settings_names=None):
+    profile = load_machine_profile()
+    decision = {"mode": mode, "audio_seconds": audio_length, "deadline_seconds": deadline,
+                "machine": socket.gethostname(), "decided_at": time.strftime("%Y-%m-%d %H:%M:%S")}
+
+    estimates = [(model_name, settings_name, estimate_real_time_factor(profile, mode, model_name, settings_name))
+                 for model_name, settings_name in CANDIDATES
+                 if settings_names is None or settings_name in settings_names]
+    estimates = [estimate for estimate in estimates if estimate[2] is not None]
+    if not estimates:
+        model_name, settings_name = DEFAULT_CANDIDATE
+        decision.update({"model": model_name, "settings": settings_name, "real_time_factor": None,
+                         "expected_seconds": None, "reason": "no real-time factors measured on this machine"})
+    else:
+        fitting = [estimate for estimate in estimates if estimate[2] * audio_length * SAFETY_MARGIN <= deadline]
+        if fitting:
+            model_name, settings_name, real_time_factor = fitting[0]
+            reason = "largest candidate expected to meet the deadline"
+        else:
+            model_name, settings_name, real_time_factor = min(estimates, key=lambda estimate: estimate[2])
+            reason = "deadline can not be met, using the fastest candidate"
+        decision.update({"model": model_name, "settings": settings_name, "real_time_factor": real_time_factor,
+                         "expected_seconds": real_time_factor * audio_length, "reason": reason})
+    decision["decoding_options"] = DECODING_SETTINGS[decision["settings"]]
+    print(f"Chose {decision['model']} ({decision['settings']}): {decision['reason']}")
+    return decision
+
+
+# Function to store the scheduling decision (and later the actual duration) next to the results of a job
+# PARAMS:
+# filepath (string): path of the transcribed source file
+# decision (dict): result of choose_model, extended by any further fields to store
+def write_job_metadata(filepath, decision):
+    base_name = os.path.basename(filepath).split('.')[0]
+    with open(f"Transcription/results/{base_name}_job.json", "w", encoding="utf-8") as outFile:
+        json.dump(decision, outFile, indent=2)
+
+
+# Function to measure the real-time factors of the chunked mode for all candidates on this machine
+# PARAMS:
+# sample_filepath (string): path of a representative mp3/m4a/mp4 recording
+# device (string): device to load the models to
+# chunk_count (int): number of chunks to decode per candidate
+def calibrate(sample_filepath, device="cuda", chunk_count=4):
+    import whisper
+    from Tools import process_file, TranscriptionJob
+    from Decoding import transcribe_chunks
+
+    job = TranscriptionJob()
+    chunk_filepaths = process_file(sample_filepath, Queue(), Queue(), job)[:chunk_count]
+    for model_name in MODEL_SIZES:
+        model = whisper.load_model(model_name, device=device)
+        for settings_name, settings in DECODING_SETTINGS.items():
+            _, _, _, decoding_durations = transcribe_chunks(model, chunk_filepaths, Queue(),
+                                                            decoding_options=settings, job=job)
+            # every chunk moves the transcription on by the piece length of the recording
+            real_time_factor = sum(decoding_durations) / (len(chunk_filepaths) * job.piece_length)
+            record_real_time_factor("chunked", model_name, settings_name, real_time_factor, weight=1)
+            print(f"{model_name} ({settings_name}): real-time factor {real_time_factor:.3f}")
+        del model
+
+
+# Usage:
+# python Scheduling.py calibrate <sample file> [device]   measure the real-time factors of all candidates
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == "calibrate":
+        calibrate(sys.argv[2], *sys.argv[3:4])
@@ -0,0 +1,307 @@
+import os
+import re
+import sys
+import json
+import time
+import socket
+import tempfile
+import multiprocessing
+from queue import Queue
+
+from Tools import process_file, knit_texts
+
+# Define how long a claimed chunk stays reserved for a worker before other workers may take it over (in seconds).
+# Nodes should have roughly synchronized clocks, since expiry is compared against the local time of every node
+LEASE_SECONDS = 600
+
+# Define how often a chunk is tried before it is marked as failed
+MAX_ATTEMPTS = 3
+
+# Define how long workers and the finalizer wait before checking the work queue again (in seconds)
+POLL_SECONDS = 1
+
+
+# Function to write a json file so that readers on other nodes never see it half written
+def _write_json_atomic(filepath, content):
+    temp_filepath = f"{filepath}.{socket.gethostname()}.{os.getpid()}.tmp"
+    with open(temp_filepath, "w", encoding="utf-8") as outFile:
+        json.dump(content, outFile)
+    os.replace(temp_filepath, filepath)
+
+
+def _read_json(filepath):
+    with open(filepath, "r", encoding="utf-8") as inFile:
+        return json.load(inFile)
+
+
+def _item_name(index):
+    return f"{index:05d}.json"
+
+
+# Function to publish the chunks of one recording as work items in a directory shared by all nodes.
+# Creates the subdirectories items, leases, results and failed within job_directory.
+# PARAMS:
+# job_directory (string): path to the shared job directory
+# chunk_filepaths (list of string): paths to the audio chunks, reachable from all nodes
+def publish_job(job_directory, chunk_filepaths):
+    for name in ["items", "leases", "results", "failed"]:
+        os.makedirs(os.path.join(job_directory, name), exist_ok=True)
+    for index, chunk_filepath in enumerate(chunk_filepaths):
+        _write_json_atomic(os.path.join(job_directory, "items", _item_name(index)),
+                           {"index": index, "path": os.path.abspath(chunk_filepath)})
+    _write_json_atomic(os.path.join(job_directory, "job.json"), {"chunk_count": len(chunk_filepaths)})
+
+
+# Function to create a lease file exclusively, so only one worker can hold it
+# RETURNS: whether the lease was created (bool)
+def _create_lease(lease_filepath, lease):
+    try:
+        lease_file = os.open(lease_filepath, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(lease_file, "w", encoding="utf-8") as outFile:
+        json.dump(lease, outFile)
+    return True
+
+
+# Function to take an existing lease away from the leases directory. The lease is moved aside atomically and only kept
+# away if it is the expected one, otherwise it is put back (without replacing a lease created in the meantime), since
+# another worker may have replaced the lease between reading and moving it.
+# PARAMS:
+# lease_filepath (string): path of the lease file
+# worker_id (string): id of the worker taking the lease
+# is_expected (function): takes the content of the moved lease and returns whether it may be taken
+# RETURNS: whether the lease was taken (bool)
+def _take_lease(lease_filepath, worker_id, is_expected):
+    moved_filepath = f"{lease_filepath}.{worker_id}.taken"
+    try:
+        os.rename(lease_filepath, moved_filepath)
+    except FileNotFoundError:
+        return False
+    try:
+        lease = _read_json(moved_filepath)
+    except json.JSONDecodeError:
+        # a new lease that is still being written
+        lease = None
+    if lease is not None and is_expected(lease):
+        os.remove(moved_filepath)
+        return True
+    try:
+        os.link(moved_filepath, lease_filepath)
+    except FileExistsError:
+        # the item was claimed again in the meantime, both workers transcribe it (their results are the same)
+        pass
+    os.remove(moved_filepath)
+    return False
+
+
+# Function to try to take over a single work item. A lease file is created exclusively, so only one worker can hold
+# it. Expired leases (worker crashed or was killed) are first taken away (see _take_lease), which only succeeds for
+# the expired lease that was read, and then claimed with an increased attempt count.
+# RETURNS: attempt number (int) if the item was claimed, otherwise None
+def _claim_item(job_directory, index, worker_id, lease_seconds):
+    lease_filepath = os.path.join(job_directory, "leases", _item_name(index))
+    # skip items that were finished in the meantime
+    if os.path.exists(os.path.join(job_directory, "results", _item_name(index))):
+        return None
+    attempt = 1
+    if os.path.exists(lease_filepath):
+        try:
+            lease = _read_json(lease_filepath)
+        except (FileNotFoundError, json.JSONDecodeError):
+            # lease is just being written or removed by another worker
+            return None
+        if lease["expires"] > time.time():
+            return None
+        if lease["attempt"] >= MAX_ATTEMPTS:
+            # keep the expired lease, so the item can not be claimed again, and mark it as failed
+            _write_json_atomic(os.path.join(job_directory, "failed", _item_name(index)),
+                               {"index": index, "attempts": lease["attempt"], "error": lease.get("error")})
+            return None
+        if not _take_lease(lease_filepath, worker_id, lambda moved_lease: moved_lease == lease):
+            # another worker took over the expired lease first
+            return None
+        attempt = lease["attempt"] + 1
+
+    if not _create_lease(lease_filepath, {"worker": worker_id, "expires": time.time() + lease_seconds,
+                                          "attempt": attempt}):
+        return None
+    return attempt
+
+
+# Function to check which chunks of a job are finished
+# RETURNS: Tuple of chunk count (int), set of finished indices and set of failed indices
+def get_job_status(job_directory):
+    chunk_count = _read_json(os.path.join(job_directory, "job.json"))["chunk_count"]
+    finished = {int(name.split(".")[0]) for name in os.listdir(os.path.join(job_directory, "results"))
+                if name.endswith(".json")}
+    failed = {int(name.split(".")[0]) for name in os.listdir(os.path.join(job_directory, "failed"))
+              if name.endswith(".json")}
+    return chunk_count, finished, failed
+
+
+# Function to run a worker that claims chunks of a job, transcribes them and writes one result file per chunk.
+# Returns as soon as every chunk is either finished or failed. Can run on any node that sees the job directory.
+# PARAMS:
+# job_directory (string): path to the shared job directory
+# transcribe_chunk (function): takes the filepath of an audio chunk and returns its text
+# lease_seconds (int): time after which a claimed chunk may be taken over by other workers
+# RETURNS: number of chunks (int) transcribed by this worker
+def run_worker(job_directory, transcribe_chunk, lease_seconds=LEASE_SECONDS):
+    worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    transcribed = 0
+    while True:
+        chunk_count, finished, failed = get_job_status(job_directory)
+        open_indices = [index for index in range(chunk_count) if index not in finished and index not in failed]
+        if not open_indices:
+            return transcribed
+
+        claimed = False
+        for index in open_indices:
+            attempt = _claim_item(job_directory, index, worker_id, lease_seconds)
+            if attempt is None:
+                continue
+            claimed = True
+            lease_filepath = os.path.join(job_directory, "leases", _item_name(index))
+
+            # the lease may have expired and been taken over by another worker, only touch it while it is our own
+            def is_own_lease(lease):
+                return lease["worker"] == worker_id and lease["attempt"] == attempt
+
+            item = _read_json(os.path.join(job_directory, "items", _item_name(index)))
+            try:
+                text = transcribe_chunk(item["path"])
+            except Exception as e:
+                # let the lease expire immediately, so the chunk gets retried (by any worker). The lease is replaced
+                # in one step, the item must never be without a lease, or it would be claimed with a new attempt count
+                print(f"Chunk {index} failed in attempt {attempt} on {worker_id}: {e}")
+                try:
+                    lease = _read_json(lease_filepath)
+                except (FileNotFoundError, json.JSONDecodeError):
+                    lease = None
+                if lease is not None and is_own_lease(lease):
+                    _write_json_atomic(lease_filepath, {"worker": worker_id, "expires": 0, "attempt": attempt,
+                                                        "error": str(e)})
+                continue
+            _write_json_atomic(os.path.join(job_directory, "results", _item_name(index)),
+                               {"index": index, "text": text, "worker": worker_id, "attempt": attempt})
+            _take_lease(lease_filepath, worker_id, is_own_lease)
+            transcribed += 1
+
+        # everything left is leased by other workers, wait for them to finish or for their leases to expire
+        if not claimed:
+            time.sleep(POLL_SECONDS)
+
+
+# Function to wait until all chunks of a job are finished and knit their texts together
+# PARAMS:
+# job_directory (string): path to the shared job directory
+# timeout (float): maximum time to wait in seconds (None to wait forever)
+# RETURNS: knitted transcription (string)
+def finalize_job(job_directory, timeout=None):
+    start_time = time.time()
+    while True:
+        chunk_count, finished, failed = get_job_status(job_directory)
+        if failed:
+            raise Exception(f"Chunks {sorted(failed)} of job {job_directory} failed {MAX_ATTEMPTS} times")
+        if len(finished) == chunk_count:
+            break
+        if timeout is not None and time.time() - start_time > timeout:
+            raise TimeoutError(f"Only {len(finished)}/{chunk_count} chunks of job {job_directory} are finished")
+        time.sleep(POLL_SECONDS)
+
+    texts = [_read_json(os.path.join(job_directory, "results", _item_name(index)))["text"]
+             for index in range(chunk_count)]
+    return knit_texts(texts)
+
+
+# Transcriber that decodes audio chunks with a Whisper model, loaded on first use in the worker process
+class WhisperTranscriber:
+    def __init__(self, model_name="large-v3", device="cuda"):
+        self.model_name = model_name
+        self.device = device
+        self.model = None
+
+    def __call__(self, chunk_filepath):
+        import whisper
+        if self.model is None:
+            self.model = whisper.load_model(self.model_name, device=self.device)
+        audio = whisper.pad_or_trim(whisper.load_audio(chunk_filepath))
+        mel = whisper.log_mel_spectrogram(audio, n_mels=self.model.dims.n_mels).to(self.model.device)
+        options = whisper.DecodingOptions(fp16=self.device != "cpu")
+        return whisper.decode(self.model, mel, options).text
+
+
+# Stand-in for Whisper to test the work queue locally: returns a fixed text per chunk (chunk index taken from the
+# filename, e.g. audio12.mp3) after a fixed latency. Chunks listed in fail_once raise an error on their first attempt.
+class StubTranscriber:
+    def __init__(self, chunk_texts, latency=0.1, fail_once=(), marker_directory=None):
+        self.chunk_texts = chunk_texts
+        self.latency = latency
+        self.fail_once = set(fail_once)
+        self.marker_directory = marker_directory
+
+    def __call__(self, chunk_filepath):
+        index = int(re.search(r'(\d+)\.[^.]*$', os.path.basename(chunk_filepath)).group(1))
+        time.sleep(self.latency)
+        if index in self.fail_once:
+            marker_filepath = os.path.join(self.marker_directory, f"failed{index}")
+            if not os.path.exists(marker_filepath):
+                open(marker_filepath, "w").close()
+                raise RuntimeError(f"simulated failure of chunk {index}")
+        return self.chunk_texts[index]
+
+
+# Function to run a job with several local worker processes and a stub model. One worker gets killed while holding a
+# lease and some chunks fail once, so expiry and retry are exercised as well.
+# PARAMS:
+# chunk_count (int): number of chunks of the simulated recording
+# worker_count (int): number of worker processes
+# latency (float): simulated decoding time per chunk in seconds
+# RETURNS: Tuple of the knitted result and the result of knitting the same chunks in a single process
+def run_local_test(chunk_count=40, worker_count=4, latency=0.2):
+    from Benchmark import generate_overlapping_chunks
+    _, chunk_texts = generate_overlapping_chunks(chunk_count)
+    job_directory = tempfile.mkdtemp(prefix="sharding_")
+    publish_job(job_directory, [os.path.join(job_directory, f"audio{i}.mp3") for i in range(chunk_count)])
+    transcriber = StubTranscriber(chunk_texts, latency, fail_once=range(0, chunk_count, 7),
+                                  marker_directory=job_directory)
+
+    start_time = time.time()
+    lease_seconds = 4 * latency
+    workers = [multiprocessing.Process(target=run_worker, args=(job_directory, transcriber, lease_seconds))
+               for _ in range(worker_count)]
+    for worker in workers:
+        worker.start()
+    # simulate a node going down while it holds a lease
+    time.sleep(latency * 1.5)
+    workers[0].kill()
+
+    result = finalize_job(job_directory, timeout=chunk_count * latency * 10)
+    for worker in workers:
+        worker.join()
+    print(f"Transcribed {chunk_count} chunks with {worker_count} workers in {time.time() - start_time:.2f} seconds "
+          f"({chunk_count * latency:.2f} seconds of simulated decoding).")
+    single_process_result = knit_texts(chunk_texts)
+    print("Result matches single process knitting." if result == single_process_result else
+          "Alert: Result differs from single process knitting!")
+    return result, single_process_result
+
+
+# Usage:
+# python Sharding.py publish <job directory> <source file>   split the source file and publish its chunks
+# python Sharding.py worker <job directory> [model name]     transcribe chunks until the job is done
+# python Sharding.py finalize <job directory> <output file>  wait for all chunks and write the knitted result
+# python Sharding.py test                                    run a local test with stub model and worker processes
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else "test"
+    if command == "publish":
+        publish_job(sys.argv[2], process_file(sys.argv[3], Queue(), Queue()))
+    elif command == "worker":
+        count = run_worker(sys.argv[2], WhisperTranscriber(*sys.argv[3:4]))
+        print(f"Worker finished after transcribing {count} chunks.")
+    elif command == "finalize":
+        with open(sys.argv[3], "w", encoding="utf-8") as outFile:
+            outFile.write(finalize_job(sys.argv[2]))
+    else:
+        run_local_test()
@@ -0,0 +1,109 @@
+import csv
+import time
+import itertools
+import multiprocessing
+from functools import partial
+
+from Tools import get_window_ratios, select_overlap_start, collapse_repetitions, append_stitched_text, \
+    convert_to_duration, TranscriptionJob
+from ChunkRecords import ChunkRecordReader
+
+# Define the default parameter grid of the sweep
+THRESHOLDS = [threshold / 100.0 for threshold in range(30, 90, 5)]
+OVERLAP_LENGTHS = [100, 150, 200, 300]
+WINDOW_SIZES = [10, 20, 30, 40]
+EXPONENTS = [1, 2, 3, 4]
+
+SWEEP_HEADER = ["Line", "Overlap_Length", "Window_Size", "Exponent", "Threshold",
+                "Adjusted_Start", "Start", "Fitness_Start", "Adjusted_End", "End", "Fitness_End"]
+
+
+# Function to knit the chunk texts like Tools.iterate_knitted_texts once for every overlap length, so every pair is
+# swept on the same base the knitter stitches on: the end of the knitted text (with the merged overlap of the previous
+# boundary and the time stamps) of the previous chunks, and the repetition collapsed text of the next chunk. The
+# previous boundaries are knitted with the default window size, exponent and threshold, so for those parameters the
+# sweep approximates the knitter that would use them at every boundary.
+# RETURNS: Generator of tuples of the pair index, a dictionary of overlap length to base and the next chunk's text
+def iterate_stitching_bases(lines, overlap_lengths):
+    jobs = {overlap_length: TranscriptionJob(maximum_overlap_length=overlap_length)
+            for overlap_length in overlap_lengths}
+    results = {}
+    for index, line in enumerate(lines):
+        value, _ = collapse_repetitions(line, *TranscriptionJob().repetition_parameters())
+        if index == 0:
+            results = {overlap_length: "[" + convert_to_duration(0) + "] " + value
+                       for overlap_length in overlap_lengths}
+            continue
+        bases = {overlap_length: result[-overlap_length:] for overlap_length, result in results.items()}
+        yield index - 1, bases, value
+        results = {overlap_length: append_stitched_text(base, value, index, jobs[overlap_length])
+                   for overlap_length, base in bases.items()}
+
+
+# Function to evaluate all parameter combinations for one pair of successive chunk texts.
+# The match ratios of the windows only depend on the texts and the overlap length, so they are computed once per
+# overlap length (for the largest window size) and reused for all thresholds, window sizes and exponents.
+# PARAMS:
+# pair (tuple): index of the pair, the base of every overlap length and the next text (see iterate_stitching_bases)
+# overlap_lengths, window_sizes, exponents, thresholds (list): values to sweep
+# RETURNS: List of result rows (see SWEEP_HEADER)
+def sweep_pair(pair, overlap_lengths, window_sizes, exponents, thresholds):
+    index, bases, text2 = pair
+    rows = []
+    ratio_cache = {}
+    for overlap_length in overlap_lengths:
+        # same base as in knit_texts: end of the knitted text of the previous chunks
+        base = bases[overlap_length]
+        if base not in ratio_cache:
+            ratio_cache[base] = (get_window_ratios(base, text2, max(window_sizes)),
+                                 get_window_ratios(text2[::-1], base[::-1], max(window_sizes)))
+        forward_results, backward_results = ratio_cache[base]
+
+        for window_size, exponent, threshold in itertools.product(window_sizes, exponents, thresholds):
+            # catch case where one of the texts contains no words (get_overlap_start would return -1)
+            if forward_results is None:
+                rows.append([index, overlap_length, window_size, exponent, threshold, -1, -1, -1, -1, -1, -1])
+                continue
+            adj_start1, start1, fitness1 = select_overlap_start(base, forward_results[:window_size], True,
+                                                                threshold, exponent)
+            adj_end2, end2, fitness2 = select_overlap_start(text2[::-1], backward_results[:window_size], False,
+                                                            threshold, exponent)
+            rows.append([index, overlap_length, window_size, exponent, threshold,
+                         adj_start1, start1, round(fitness1, 2),
+                         len(text2) - adj_end2, len(text2) - end2, round(fitness2, 2)])
+    return rows
+
+
+# Function to sweep the knitting parameters over all pairs of successive chunk texts in parallel and write the
+# results into one tidy CSV file (one row per pair and parameter combination). The pairs are produced one at a time
+# (see iterate_stitching_bases) while the pool consumes them.
+# PARAMS:
+# lines (iterable of string): chunk texts in order (read lazily, e.g. ChunkRecordReader.texts)
+# output_filepath (string): path of the CSV file to write
+# processes (int): number of worker processes (None for one per CPU)
+def sweep_knitting_parameters(lines, output_filepath="Transcription/sweep_results.csv", overlap_lengths=None,
+                              window_sizes=None, exponents=None, thresholds=None, processes=None):
+    overlap_lengths = overlap_lengths or OVERLAP_LENGTHS
+    sweep_function = partial(sweep_pair,
+                             overlap_lengths=overlap_lengths,
+                             window_sizes=window_sizes or WINDOW_SIZES,
+                             exponents=exponents or EXPONENTS,
+                             thresholds=thresholds or THRESHOLDS)
+
+    start_time = time.time()
+    pair_count = 0
+    row_count = 0
+    with open(output_filepath, "w", newline="") as file, multiprocessing.Pool(processes) as pool:
+        writer = csv.writer(file)
+        writer.writerow(SWEEP_HEADER)
+        for i, rows in enumerate(pool.imap(sweep_function, iterate_stitching_bases(lines, overlap_lengths), chunksize=4)):
+            writer.writerows(rows)
+            pair_count += 1
+            row_count += len(rows)
+            if i % 20 == 0:
+                print(f"Progress: at line {i}")
+    print(f"Swept {pair_count} pairs into {row_count} rows in {time.time() - start_time:.1f} seconds.")
+
+
+if __name__ == '__main__':
+    sweep_knitting_parameters(ChunkRecordReader("Transcription/output_chunks.jsonl").texts())
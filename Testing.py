@@ -1,17 +1,17 @@
 from difflib import SequenceMatcher
+import os
 import statistics
 import json
 import csv
 import re
 from tkinter import filedialog
 
-from Tools import get_file_duration
+from Tools import get_file_duration, collapse_repetitions, OverlapTracer, PIECE_LENGTH, MINIMUM_MATCH_THRESHOLD, \
+    MAXIMUM_OVERLAP_LENGTH
+from ChunkRecords import ChunkRecordReader, convert_long_text
 
-# Define the length of each piece in seconds
-PIECE_LENGTH = 15
-MINIMUM_MATCH_THRESHOLD = 0.5
-MAXIMUM_OVERLAP_LENGTH = 200
-total_statistics = []
+# tracer to stream the evaluated windows of every overlap search to (see write_length_ratio_results)
+statistics_tracer = None
 
 def get_space_positions(text):
     return [i for i, char in enumerate(text) if char == ' ']
@@ -112,7 +112,12 @@ def get_overlap_start_v2(primary, secondary, adjust_backwards=True, max_window_s
     fitness_values = [fitness_function(len(primary) - start, ratio) for _, start, ratio in results]
     max_fitness_index = fitness_values.index(max(fitness_values))
 
-    total_statistics.append((zip(results, fitness_values), secondary))
+    if statistics_tracer is not None:
+        statistics_tracer.write({"window_size": [window_size for window_size, _, _ in results],
+                                 "start": [start for _, start, _ in results],
+                                 "ratio": [ratio for _, _, ratio in results],
+                                 "fitness": fitness_values,
+                                 "secondary": secondary})
 
     # Get the start position with the maximum fitness value
     start = results[max_fitness_index][1]
@@ -184,28 +189,30 @@ def test_overlap_detection(lines):
             print(f"Processed line {i}")
 
 
-def write_length_ratio_results():
-    stuff = list(enumerate(total_statistics))
-    # Initialize the CSV writer
-    with open("Transcription/length_ratio_results.csv", "w", newline="") as file:
+# Function to convert the trace written by get_overlap_start_v2 into CSV files, reading it one record at a time
+# PARAMS:
+# trace_filepath (string): path to the JSONL file written by statistics_tracer
+def write_length_ratio_results(trace_filepath="Transcription/length_ratio_trace.jsonl"):
+    # Initialize the CSV writers
+    with open(trace_filepath, "r", encoding="utf-8") as inFile, \
+            open("Transcription/length_ratio_results.csv", "w", newline="") as file, \
+            open("Transcription/indizes.csv", "w", newline="") as indexFile:
         writer = csv.writer(file, delimiter=';')
+        index_writer = csv.writer(indexFile, delimiter=';')
 
-        # Write the header row
+        # Write the header rows
         writer.writerow(["Sample Index", "Window Size", "Start Position", "Match Ratio", "Fitness Value"])
+        index_writer.writerow(["Index", "Content"])
 
-        for index, entry in stuff:
+        for index, line in enumerate(inFile):
+            entry = json.loads(line)
             # Write each result along with the corresponding fitness value
-            for (window_size, start, ratio), fitness in entry[0]:
+            for window_size, start, ratio, fitness in zip(entry["window_size"], entry["start"], entry["ratio"],
+                                                          entry["fitness"]):
                 ratio_str = "{:.2f}".format(ratio).replace('.', ',')
                 fitness_str = "{:.2f}".format(fitness).replace('.', ',')
                 writer.writerow([index, window_size, start, ratio_str, fitness_str])
-
-    with open("Transcription/indizes.csv", "w", newline="") as file:
-        writer = csv.writer(file, delimiter=';')
-        writer.writerow(["Index", "Content"])
-
-        for index, entry in stuff:
-            writer.writerow([index, entry[1]])
+            index_writer.writerow([index, entry["secondary"]])
 
 
 def test_stats(lines):
@@ -304,26 +311,25 @@ def convert_to_duration(count_seconds):
 
 
 def knit_texts(text_chunks):
-    # create new list for corrected texts
-    processed_chunks = []
+    result = ""
 
-    # correct for repetition errors (Whisper sometimes repeats sentences multiple times for no apparent reason)
-    pattern = re.compile(r'(\D+?)\1{2,}')
-    for text in text_chunks:
-        processed_chunks.append(pattern.sub(r'\1', text))
+    # iterate through all text chunks one at a time, stitch second half of previous chunk to first half of latter chunk
+    for index, text in enumerate(text_chunks):
+        # correct for repetition errors (Whisper sometimes repeats sentences multiple times for no apparent reason)
+        value = collapse_repetitions(text)[0]
 
-    # start final result with 0th time stamp and first half of first text chunk
-    result = "[" + convert_to_duration(0) + "] " + processed_chunks[0]
+        # start final result with 0th time stamp and first half of first text chunk
+        if index == 0:
+            result = "[" + convert_to_duration(0) + "] " + value
+            continue
 
-    # iterate through all text chunks, stitch second half of previous chunk to first half of latter chunk
-    for index, value in enumerate(processed_chunks[1:]):
         # calculate the base string on which to stitch the next chunk
         # take last MAXIMUM_OVERLAP_LENGTH characters of current result if it is longer, otherwise just the whole result
         base = result[-MAXIMUM_OVERLAP_LENGTH:] if len(result) > MAXIMUM_OVERLAP_LENGTH else result
 
         rest1, overlap_text, rest2 = stitch_texts(base, value)
         result = result[:-MAXIMUM_OVERLAP_LENGTH] + rest1
-        result += " [" + convert_to_duration((index + 1) * PIECE_LENGTH) + "]"
+        result += " [" + convert_to_duration(index * PIECE_LENGTH) + "]"
 
         # check if overlap exists (in case, nothing was said during that time frame)
         if overlap_text:
@@ -336,14 +342,17 @@ def knit_texts(text_chunks):
 
 if __name__ == '__main__':
 
-    text_lines = []
-    with open("Transcription/output_long.txt", "r", encoding="utf-8") as inFile:
-        for line in inFile:
-            line = line.strip()  # Remove leading/trailing whitespace
-            if line:  # Only append non-empty lines
-                text_lines.append(line)
-    print("Reading complete")
-    total_result = knit_texts(text_lines)
+    records_filepath = "Transcription/output_chunks.jsonl"
+    # convert legacy dumps of chunk texts separated by blank lines
+    if not os.path.exists(records_filepath):
+        convert_long_text("Transcription/output_long.txt", records_filepath, PIECE_LENGTH)
+    chunk_records = ChunkRecordReader(records_filepath)
+    print(f"Found {len(chunk_records)} chunks")
+    # start a new trace for this run
+    open("Transcription/length_ratio_trace.jsonl", "w").close()
+    statistics_tracer = OverlapTracer("Transcription/length_ratio_trace.jsonl")
+    total_result = knit_texts(chunk_records.texts())
+    statistics_tracer.close()
     with open("Transcription/output.txt", "w", encoding="utf-8") as outFile:
         outFile.write(total_result)
     write_length_ratio_results()
@@ -1,9 +1,18 @@
 import os
+import sys
 import math
 import re
+import json
+import time
+import ctypes
+import random
+import string
+import threading
 import subprocess
+import tracemalloc
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import moviepy.editor as mp
-from pydub import AudioSegment
 from tkinter import filedialog
 from difflib import SequenceMatcher
 from pydub.utils import mediainfo
@@ -15,12 +24,93 @@ PIECE_LENGTH = 15
 # Define additional overlap between two successive parts in seconds
 OVERLAP_SECONDS = 5
 
-# define variable for piece_count. gets set at the beginning of splitting the video (even before checking whether
-# splitting is necessary)
-piece_count = 0
+# Define the maximum number of ffmpeg processes extracting chunks at the same time
+SPLIT_WORKERS = min(4, os.cpu_count() or 1)
 
 MINIMUM_MATCH_THRESHOLD = 0.5
 MAXIMUM_OVERLAP_LENGTH = 200
+# exponent of the match ratio in the fitness of an overlap window (higher values favour exact matches over length)
+FITNESS_EXPONENT = 3
+
+# Define when a chunk counts as containing no speech when skipping chunks without speech (see TranscriptionJob):
+# its loudest frame is quieter than SILENCE_THRESHOLD_DB (in dB relative to full scale, checked before the encoder
+# runs) or the no-speech probability after Whisper's first decoder step is above NO_SPEECH_THRESHOLD. The latter is
+# higher than the 0.6 of whisper.transcribe, which also requires a low average log-probability of the decoded text.
+SILENCE_THRESHOLD_DB = -50
+NO_SPEECH_THRESHOLD = 0.8
+
+# Define from which size on glibc serves allocations with mmap in the bounded-memory mode (see bound_heap_growth)
+MMAP_THRESHOLD_BYTES = 128 * 1024
+
+# Define the parameters for collapsing repetitions (Whisper sometimes gets stuck in a loop and repeats itself)
+# shortest and longest repeated span in words and how often a span has to occur in a row to be collapsed
+REPETITION_MIN_SPAN = 1
+REPETITION_MAX_SPAN = 40
+REPETITION_MIN_REPEATS = 3
+
+# Define the parameters for stitching chunks on Whisper's token IDs instead of characters
+# maximum number of tokens at the end/start of two successive chunks that are searched for the overlap and
+# minimum number of consecutive equal tokens to accept as part of the overlap
+MAXIMUM_OVERLAP_TOKENS = 60
+MINIMUM_TOKEN_MATCH = 3
+
+
+# Class holding the chunking and knitting parameters and the state of a single transcription job.
+# The module constants above are only its defaults. All functions of the pipeline take a job (a new default job if
+# none is given) instead of reading or writing module state, so jobs with different parameters can run at the same
+# time in threads or async tasks.
+# PARAMS:
+# piece_length (int): seconds between the starts of two successive chunks
+# overlap_seconds (int): additional seconds every chunk overlaps with the next one
+# split_workers (int): maximum number of ffmpeg processes extracting chunks at the same time
+# minimum_match_threshold (float), fitness_exponent (float): see select_overlap_start
+# maximum_overlap_length (int): number of characters at the end of the knitted text to search the overlap in
+# max_window_size (int): see get_window_ratios
+# repetition_min_span, repetition_max_span, repetition_min_repeats (int): see find_repetitions
+# maximum_overlap_tokens, minimum_token_match (int): see stitch_tokens
+# overlap_tracer (OverlapTracer): tracer for the decisions of stitch_texts, tracing is disabled if None
+# bounded_memory (bool): whether to keep the memory usage independent of the recording's length (the results of the
+# chunks are only streamed to the chunk records instead of also being collected in memory)
+# skip_no_speech (bool): whether to give chunks without speech an empty result instead of decoding them
+# silence_threshold_db (float), no_speech_threshold (float): when a chunk counts as containing no speech
+class TranscriptionJob:
+    def __init__(self, piece_length=PIECE_LENGTH, overlap_seconds=OVERLAP_SECONDS, split_workers=SPLIT_WORKERS,
+                 minimum_match_threshold=MINIMUM_MATCH_THRESHOLD, maximum_overlap_length=MAXIMUM_OVERLAP_LENGTH,
+                 fitness_exponent=FITNESS_EXPONENT, max_window_size=30, repetition_min_span=REPETITION_MIN_SPAN,
+                 repetition_max_span=REPETITION_MAX_SPAN, repetition_min_repeats=REPETITION_MIN_REPEATS,
+                 maximum_overlap_tokens=MAXIMUM_OVERLAP_TOKENS, minimum_token_match=MINIMUM_TOKEN_MATCH,
+                 overlap_tracer=None, bounded_memory=False, skip_no_speech=False,
+                 silence_threshold_db=SILENCE_THRESHOLD_DB, no_speech_threshold=NO_SPEECH_THRESHOLD):
+        self.piece_length = piece_length
+        self.overlap_seconds = overlap_seconds
+        self.split_workers = split_workers
+        self.minimum_match_threshold = minimum_match_threshold
+        self.maximum_overlap_length = maximum_overlap_length
+        self.fitness_exponent = fitness_exponent
+        self.max_window_size = max_window_size
+        self.repetition_min_span = repetition_min_span
+        self.repetition_max_span = repetition_max_span
+        self.repetition_min_repeats = repetition_min_repeats
+        self.maximum_overlap_tokens = maximum_overlap_tokens
+        self.minimum_token_match = minimum_token_match
+        self.overlap_tracer = overlap_tracer
+        self.bounded_memory = bounded_memory
+        self.skip_no_speech = skip_no_speech
+        self.silence_threshold_db = silence_threshold_db
+        self.no_speech_threshold = no_speech_threshold
+        # number of chunks of the job's recording. gets set at the beginning of splitting the recording (even before
+        # checking whether splitting is necessary)
+        self.piece_count = 0
+        # chunks that were not decoded as tuples of chunk index and reason ("silence" or "no speech"), gets set while
+        # decoding
+        self.skipped_chunks = []
+
+    # length of every chunk in seconds
+    def chunk_length(self):
+        return self.piece_length + self.overlap_seconds
+
+    def repetition_parameters(self):
+        return self.repetition_min_span, self.repetition_max_span, self.repetition_min_repeats
 
 
 # Function to extract the audio track from a video file
@@ -33,29 +123,28 @@ def extract_audio(input_filepath, output_filepath):
     if os.path.isfile(output_filepath):
         return
 
-    # open the original video file as an audio segment
-    video = AudioSegment.from_file(input_filepath)
-    # save the audio track to a new file in MP3 format
-    video.export(output_filepath, format='mp3')
+    # let ffmpeg stream the audio track into a new file in MP3 format (never holds the whole track in memory), under a
+    # temporary name first so an interrupted run does not leave a partial audio track behind
+    subprocess.run(["ffmpeg", "-nostdin", "-loglevel", "error", "-y", "-i", input_filepath, "-vn", "-c:a", "libmp3lame",
+                    "-f", "mp3", output_filepath + ".part"], check=True)
+    os.replace(output_filepath + ".part", output_filepath)
 
 
 # Function to split a video file into pieces -------- DEPRECATED
-def split_video(input_filename, progress_queue, maximum_queue):
+def split_video(input_filename, progress_queue, maximum_queue, job=None):
+    job = job or TranscriptionJob()
     # Use ffmpeg to split the input file into pieces of the specified length
     path_parts = os.path.split(input_filename)
     dir_name = os.path.join(path_parts[0], "temp", os.path.splitext(os.path.basename(input_filename))[0])
     length_in_seconds = mp.VideoFileClip(input_filename).duration
-    global piece_count
-    piece_count = math.floor(length_in_seconds / PIECE_LENGTH)
-    if length_in_seconds - piece_count * PIECE_LENGTH > OVERLAP_SECONDS:
-        piece_count += 1
-    maximum_queue.put(piece_count*2)
-    for i in range(0, piece_count):
+    job.piece_count = get_piece_count(length_in_seconds, job)
+    maximum_queue.put(job.piece_count*2)
+    for i in range(0, job.piece_count):
         progress_queue.put(i)
         if os.path.exists(f"{dir_name}/video{i}.mp4"):
             continue
-        starttime = i * PIECE_LENGTH
-        duration = PIECE_LENGTH + OVERLAP_SECONDS
+        starttime = i * job.piece_length
+        duration = job.chunk_length()
         start = convert_to_duration(starttime)
         dur = convert_to_duration(duration)
 
@@ -77,68 +166,76 @@ def split_video(input_filename, progress_queue, maximum_queue):
         )
 
 
+# Function to extract a single chunk from an audio file with ffmpeg.
+# -ss is passed before -i (input seeking), so ffmpeg seeks to the start of the chunk instead of decoding everything
+# before it. Every chunk therefore only costs its own length, regardless of its position in the file.
+# The chunk is written under a temporary name first, so an interrupted run never leaves a partial chunk behind that
+# would be skipped as already existing by the next run.
+def extract_chunk(input_filepath, output_filepath, start, duration):
+    subprocess.run(
+        [
+            "ffmpeg",
+            "-nostdin",
+            "-loglevel",
+            "error",
+            "-y",
+            "-ss",
+            str(start),
+            "-t",
+            str(duration),
+            "-i",
+            input_filepath,
+            "-c:a",
+            "libmp3lame",
+            "-f",
+            "mp3",
+            output_filepath + ".part",
+        ],
+        check=True
+    )
+    os.replace(output_filepath + ".part", output_filepath)
+
+
 # Function to split an audio file into pieces
 # PARAMS:
 # input_filename (string): filepath to source audio file including complete filename
 # progress_queue (Queue): queue to feed current progress values to GUI refresh function
 # maximum_queue (Queue): queue to feed changes to maximum progress value to GUI refresh function
+# job (TranscriptionJob): chunking parameters (split_workers bounds the ffmpeg processes), gets the piece count
 # RETURNS: List of filepaths (string) to all audio chunks required (including chunks that may already exist)
-def split_audio(input_filepath, output_directory, progress_queue, maximum_queue):
-    # get path of directory containing source file and in which to put the chunks
-    dir_path = os.path.dirname(input_filepath)
+def split_audio(input_filepath, output_directory, progress_queue, maximum_queue, job=None):
+    job = job or TranscriptionJob()
     # check if source file exists and can be read
     try:
         length_in_seconds = mediainfo(input_filepath)["duration"]
     except KeyError:
         raise Exception(f"No audio file found at {input_filepath}")
 
-    # gain access to global variable piece_count and set it according to lengths of source file and chunks
-    global piece_count
-    piece_count = math.floor(float(length_in_seconds) / PIECE_LENGTH)
-    if float(length_in_seconds) - piece_count * PIECE_LENGTH > OVERLAP_SECONDS:
-        piece_count += 1
+    # set the job's piece count according to lengths of source file and chunks
+    job.piece_count = get_piece_count(float(length_in_seconds), job)
 
     # set maximum progress value to piece_count + 1 (one extra for first extracting the audio from the whole video file)
-    maximum_queue.put(piece_count + 1)
+    maximum_queue.put(job.piece_count + 1)
 
     # calculate duration of each chunk
-    duration = PIECE_LENGTH + OVERLAP_SECONDS
-    dur = convert_to_duration(duration)
+    dur = convert_to_duration(job.chunk_length())
 
-    # create return list
-    audio_chunks_paths = []
+    # create return list (in order of the chunks, independent of the order in which they get finished)
+    audio_chunks_paths = [f"{output_directory}/audio{i}.mp3" for i in range(job.piece_count)]
 
-    # iterate through all piece_count chunks
-    for i in range(piece_count):
+    # extract all chunks that have not been generated yet (possibly from previous run) on a bounded pool of workers
+    with ThreadPoolExecutor(max_workers=job.split_workers) as executor:
+        futures = [executor.submit(extract_chunk, input_filepath, current_chunk_filepath,
+                                   convert_to_duration(i * job.piece_length), dur)
+                   for i, current_chunk_filepath in enumerate(audio_chunks_paths)
+                   if not os.path.exists(current_chunk_filepath)]
         # update current progress value (remember, first step has already happened)
-        progress_queue.put(i+1)
-        # calculate filepath under which to write the chunk
-        current_chunk_filepath = f"{output_directory}/audio{i}.mp3"
-        # check if chunk has already been generated (possibly from previous run) and skip if that is the case
-        if os.path.exists(current_chunk_filepath):
-            audio_chunks_paths.append(current_chunk_filepath)
-            continue
-
-        # calculate start time of chunk and convert to HH:MM:SS format
-        start_time = i * PIECE_LENGTH
-        start = convert_to_duration(start_time)
-
-        # Use ffmpeg to split the input file into pieces of the specified length
-        subprocess.run(
-            [
-                "ffmpeg",
-                "-i",
-                input_filepath,
-                "-ss",
-                str(start),
-                "-t",
-                str(dur),
-                "-c:a",
-                "libmp3lame",
-                current_chunk_filepath,
-            ]
-        )
-        audio_chunks_paths.append(current_chunk_filepath)
+        finished = job.piece_count - len(futures)
+        progress_queue.put(finished + 1)
+        for future in as_completed(futures):
+            future.result()
+            finished += 1
+            progress_queue.put(finished + 1)
     return audio_chunks_paths
 
 
@@ -158,12 +255,15 @@ def open_file():
 # It catches no Exceptions but the functions called may raise some. Need to be handled above!
 # PARAMS:
 # file_path (string): file path to the source mp4/mp3/m4a file
+# job (TranscriptionJob): chunking parameters, gets the piece count of the file
 # RETURNS: List of filepaths (string) to all audio chunks required (including chunks that may already exist)
-def process_file(file_path, progress_queue, maximum_queue):
+def process_file(file_path, progress_queue, maximum_queue, job=None):
+    job = job or TranscriptionJob()
     file_type = file_path.split(".")[-1]
     # calculate path to new temporary subdirectory used for storing all intermediate files
     path_parts = os.path.split(file_path)
     new_dir = os.path.join(path_parts[0], "temp", os.path.splitext(os.path.basename(file_path))[0])
+    os.makedirs(new_dir, exist_ok=True)
     # calculate filepath of source audio in full length
     audio_track_full = os.path.join(new_dir, os.path.basename(file_path).split(".")[0] + ".mp3")
     if file_type == "mp3" or file_type == "m4a":
@@ -171,10 +271,7 @@ def process_file(file_path, progress_queue, maximum_queue):
 
     # calculate number of pieces from length of video file first
     length_in_seconds = get_file_duration(file_path)
-    global piece_count
-    piece_count = math.floor(length_in_seconds / PIECE_LENGTH)
-    if length_in_seconds - piece_count * PIECE_LENGTH > OVERLAP_SECONDS:
-        piece_count += 1
+    job.piece_count = get_piece_count(length_in_seconds, job)
 
     work_required = False
     chunk_filepaths = []
@@ -182,7 +279,7 @@ def process_file(file_path, progress_queue, maximum_queue):
     if file_type == "mp4" and not os.path.exists(audio_track_full):
         # extract audio track from source video file and store it in dedicated directory
         extract_audio(file_path, audio_track_full)
-    for i in range(piece_count):
+    for i in range(job.piece_count):
         current_chunk_filepath = f"{new_dir}/audio{i}.mp3"
         if not os.path.exists(current_chunk_filepath):
             work_required = True
@@ -192,36 +289,41 @@ def process_file(file_path, progress_queue, maximum_queue):
     # check if work is required:
     if work_required:
         # set progress bar
-        maximum_queue.put(piece_count + 1)
+        maximum_queue.put(job.piece_count + 1)
         progress_queue.put(0)
         # split full audio into chunks and return list of created filepaths
-        return split_audio(audio_track_full, new_dir, progress_queue, maximum_queue)
+        return split_audio(audio_track_full, new_dir, progress_queue, maximum_queue, job)
     else:
         # just return list of chunk filepaths
         return chunk_filepaths
 
 
+# Function to get the number of chunks of a recording: one every piece_length seconds, the remainder only gets a chunk
+# of its own if it is longer than the overlap (otherwise the previous chunk already covers it)
+def get_piece_count(length_in_seconds, job=None):
+    job = job or TranscriptionJob()
+    count = math.floor(length_in_seconds / job.piece_length)
+    if length_in_seconds - count * job.piece_length > job.overlap_seconds:
+        count += 1
+    return count
+
+
+# Function to get the length of a recording in seconds from its container with ffprobe (the audio is not decoded, so
+# this takes the same time and memory for recordings of any length)
 def get_file_duration(file_path):
     file_type = file_path.split(".")[-1]
-    
-    # For MP4 files, use ffprobe to get file info
-    if file_type == "mp4":
-        cmd = ['ffprobe', '-v', 'error', '-show_entries', 
-               'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1', 
-               file_path]
-        try:
-            output = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-            duration = float(output)
-            return duration
-        except subprocess.CalledProcessError as e:
-            print(f"Error occurred: {e.output}")
-            return None
-    # Handling for MP3 and M4A files
-    elif file_type == "mp3" or file_type == "m4a":
-        from pydub import AudioSegment
-        audio = AudioSegment.from_file(file_path, format=file_type)
-        return audio.duration_seconds
-    else:
+    if file_type not in ["mp4", "mp3", "m4a"]:
+        return None
+
+    cmd = ['ffprobe', '-v', 'error', '-show_entries',
+           'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1',
+           file_path]
+    try:
+        output = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+        duration = float(output)
+        return duration
+    except subprocess.CalledProcessError as e:
+        print(f"Error occurred: {e.output}")
         return None
 
 
@@ -229,16 +331,123 @@ def get_space_positions(text):
     return [i for i, char in enumerate(text) if char == ' ']
 
 
-def get_overlap_start(primary, secondary, adjust_backwards=True, max_window_size=30):
-    def fitness_function(character_size, match_ratio):
-        return character_size * match_ratio ** 3
+# Class to stream the per-boundary decisions of stitch_texts to a JSONL file (one compact record per traced boundary).
+# Every record holds the boundary index, the evaluated windows of the forward and backward overlap search as columns
+# (window_size, start, ratio, fitness, best = index of the chosen window), the chosen cut positions and
+# optionally the stitched texts. Lines are flushed as they are written, so a crash only loses the current boundary.
+# PARAMS:
+# filepath (string): path of the JSONL file to append to
+# sample_rate (float): share of boundaries to trace (between 0 and 1)
+# include_texts (bool): whether to also store the texts on both sides of the boundary
+class OverlapTracer:
+    def __init__(self, filepath, sample_rate=1.0, include_texts=False, seed=None):
+        self.file = open(filepath, "a", encoding="utf-8", buffering=1)
+        self.sample_rate = sample_rate
+        self.include_texts = include_texts
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def sample(self):
+        return self.sample_rate >= 1 or self.random.random() < self.sample_rate
+
+    def write(self, record):
+        line = json.dumps(record, separators=(",", ":"), ensure_ascii=False) + "\n"
+        with self.lock:
+            self.file.write(line)
+
+    def close(self):
+        self.file.close()
+
+
+# Function to stop glibc from raising its mmap threshold whenever a large block is freed. Otherwise the large buffers
+# of every block of audio (waveform, STFT, spectrogram) are allocated on the heap after the first block and its
+# fragmentation lets the resident set size grow with the number of blocks. Does nothing on other platforms.
+def bound_heap_growth():
+    try:
+        # M_MMAP_THRESHOLD, setting it also disables the dynamic adjustment
+        ctypes.CDLL("libc.so.6").mallopt(-3, MMAP_THRESHOLD_BYTES)
+    except (OSError, AttributeError):
+        pass
+
 
+# Function to get the current resident set size of this process in bytes
+def get_current_rss():
+    try:
+        with open("/proc/self/statm") as inFile:
+            return int(inFile.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        pass
+    # no procfs available, fall back to the peak of the whole process (not available on Windows)
+    try:
+        import resource
+    except ImportError:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+
+# Collects wall time, real-time factor and peak memory (Python allocations and resident set size) per pipeline stage
+class StageProfiler:
+    def __init__(self, audio_duration, trace_memory=True, sample_interval=0.01):
+        self.audio_duration = audio_duration
+        self.trace_memory = trace_memory
+        self.sample_interval = sample_interval
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        peak_rss = [get_current_rss()]
+        done_event = threading.Event()
+
+        # sample the resident set size in the background, since the process wide peak can not be reset
+        def sample_rss():
+            while not done_event.wait(self.sample_interval):
+                peak_rss[0] = max(peak_rss[0], get_current_rss())
+
+        sampler = threading.Thread(target=sample_rss, daemon=True)
+        sampler.start()
+        if self.trace_memory:
+            tracemalloc.start()
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall_time = time.perf_counter() - start_time
+            peak_python = tracemalloc.get_traced_memory()[1] if self.trace_memory else 0
+            if self.trace_memory:
+                tracemalloc.stop()
+            done_event.set()
+            sampler.join()
+            peak_rss[0] = max(peak_rss[0], get_current_rss())
+            self.stages.append((name, wall_time, wall_time / self.audio_duration, peak_python, peak_rss[0]))
+
+    def report(self):
+        print(f"{'stage':<12}{'wall [s]':>10}{'RTF':>10}{'peak py [MB]':>14}{'peak RSS [MB]':>15}")
+        for name, wall_time, real_time_factor, peak_python, peak_rss in self.stages:
+            print(f"{name:<12}{wall_time:>10.3f}{real_time_factor:>10.5f}{peak_python / 2**20:>14.1f}"
+                  f"{peak_rss / 2**20:>15.1f}")
+        total_time = sum(stage[1] for stage in self.stages)
+        print(f"{'total':<12}{total_time:>10.3f}{total_time / self.audio_duration:>10.5f}")
+
+    # Function to append the peak resident set size of every stage to a statistics file (one line per stage)
+    def write_statistics(self, filepath, label):
+        with open(filepath, "a") as outFile:
+            for name, wall_time, _, _, peak_rss in self.stages:
+                outFile.write(f"\n{name}; {peak_rss}; {wall_time}; {self.audio_duration}; {label}")
+
+
+# Function to compute how well the last words of primary match the start of secondary for growing window sizes
+# PARAMS:
+# primary (string): text whose end overlaps with secondary
+# secondary (string): text whose start overlaps with primary
+# max_window_size (int): maximum window size in words
+# RETURNS: List of tuples (window size in words, start position of the window in primary, match ratio) or
+# None if one of the texts is empty or does not contain any words
+def get_window_ratios(primary, secondary, max_window_size=30):
     # Check if the texts are not empty or just jibberish
     if not primary.strip() or not secondary.strip() or not re.search(r'\w', primary) or not re.search(r'\w', secondary):
-        print("Alert: One or both of the texts are empty, contain only whitespace, or do not contain any words!")
-        return -1, -1, -1
+        return None
 
-    # Get space positions for later adjustment
+    # Get space positions to calculate the window lengths
     spaces = get_space_positions(primary)
 
     # Initialize the sequence matcher
@@ -264,20 +473,47 @@ def get_overlap_start(primary, secondary, adjust_backwards=True, max_window_size
 
         # Store the window size, start position, and ratio
         results.append((window_size, len(primary) - window_size_chars, ratio))
+    return results
+
+
+# Function to choose the start of the overlap in primary among the windows evaluated by get_window_ratios
+# PARAMS:
+# primary (string): text whose end overlaps with secondary
+# results (list of tuples): result of get_window_ratios
+# adjust_backwards (bool): whether to move the start back (True) or forward (False) to the nearest space
+# threshold (float): minimum match ratio of the chosen window, otherwise there is no overlap
+# exponent (float): exponent of the match ratio in the fitness of a window
+# trace (dict): if not None, gets filled with all evaluated windows and the chosen one
+# RETURNS: Tuple of the start adjusted to the nearest space, the start and the fitness of the chosen window
+def select_overlap_start(primary, results, adjust_backwards=True, threshold=MINIMUM_MATCH_THRESHOLD,
+                         exponent=FITNESS_EXPONENT, trace=None):
+    def fitness_function(character_size, match_ratio):
+        return character_size * match_ratio ** exponent
 
     # catch case where nothing was said during chunk -> no text -> zero iterations over window sizes
     if not results:
         return 0, 0, 0
 
+    # Get space positions for later adjustment
+    spaces = get_space_positions(primary)
+
     # Compute fitness values and find the maximum
     fitness_values = [fitness_function(len(primary) - start, ratio) for window_size, start, ratio in results]
     max_fitness_index = fitness_values.index(max(fitness_values))
 
+    # record all evaluated windows column by column if this boundary is traced
+    if trace is not None:
+        trace.update({"window_size": [window_size for window_size, _, _ in results],
+                      "start": [start for _, start, _ in results],
+                      "ratio": [round(ratio, 4) for _, _, ratio in results],
+                      "fitness": [round(fitness, 2) for fitness in fitness_values],
+                      "best": max_fitness_index})
+
     # Get the start position with the maximum fitness value
     start = results[max_fitness_index][1]
 
     # Catch case in which there is no overlap - avoid finding false positives
-    if results[max_fitness_index][2] < MINIMUM_MATCH_THRESHOLD:
+    if results[max_fitness_index][2] < threshold:
         return len(primary), len(primary), 0
 
     # Find the position of the nearest space that is less than or equal to the start position
@@ -299,6 +535,16 @@ def get_overlap_start(primary, secondary, adjust_backwards=True, max_window_size
     return adjusted_start, start, fitness_values[max_fitness_index]
 
 
+def get_overlap_start(primary, secondary, adjust_backwards=True, trace=None, job=None):
+    job = job or TranscriptionJob()
+    results = get_window_ratios(primary, secondary, job.max_window_size)
+    if results is None:
+        print("Alert: One or both of the texts are empty, contain only whitespace, or do not contain any words!")
+        return -1, -1, -1
+    return select_overlap_start(primary, results, adjust_backwards, job.minimum_match_threshold,
+                                job.fitness_exponent, trace)
+
+
 def merge_overlaps(overlap1, overlap2):
     # Initialize the sequence matcher with the overlaps
     seq_matcher = SequenceMatcher(None, overlap1, overlap2)
@@ -339,12 +585,21 @@ def merge_overlaps(overlap1, overlap2):
     return merged_overlap
 
 
-def stitch_texts(text1, text2):
+def stitch_texts(text1, text2, boundary=None, job=None):
+    job = job or TranscriptionJob()
+    overlap_tracer = job.overlap_tracer
+    # decide whether to trace this boundary (only a single check if tracing is disabled)
+    forward_trace, backward_trace = ({}, {}) if overlap_tracer is not None and overlap_tracer.sample() else (None, None)
+
     # Compute the start of the overlap
-    adj_start1, start1, fitness1 = get_overlap_start(text1, text2)
+    adj_start1, start1, fitness1 = get_overlap_start(text1, text2, trace=forward_trace, job=job)
+    # a text without words (e.g. a chunk that was skipped for containing no speech) has no overlap to stitch on
+    if fitness1 == -1:
+        return text1.rstrip(), "", text2
 
     # Compute the end of the overlap by reversing the texts and computing the start of the overlap
-    adj_end2, end2, fitness2 = get_overlap_start(text2[::-1], text1[::-1], adjust_backwards=False)
+    adj_end2, end2, fitness2 = get_overlap_start(text2[::-1], text1[::-1], adjust_backwards=False,
+                                                 trace=backward_trace, job=job)
     adj_end2 = len(text2) - adj_end2
     end2 = len(text2) - end2
 
@@ -354,41 +609,226 @@ def stitch_texts(text1, text2):
     overlap2 = text2[:adj_end2] if fitness2 != 0 else ""
     overlap_merged = merge_overlaps(overlap1, overlap2)
 
+    if forward_trace is not None:
+        record = {"boundary": boundary, "forward": forward_trace, "backward": backward_trace,
+                  "start": [adj_start1, start1], "end": [adj_end2, end2], "fitness": [fitness1, fitness2],
+                  "overlap_length": len(overlap_merged)}
+        if overlap_tracer.include_texts:
+            record.update({"text1": text1, "text2": text2, "overlap": overlap_merged})
+        overlap_tracer.write(record)
+
     # Return the stitched text
     return text1[:adj_start1], overlap_merged, text2[adj_end2:]
 
 
+# Function to find spans that are repeated several times in a row within a sequence of words or tokens.
+# Takes O(n * max_span) time for n elements and never backtracks.
+# PARAMS:
+# keys (list): sequence of comparable elements (normalized words or token IDs)
+# min_span (int): minimum length of a repeated span in elements
+# max_span (int): maximum length of a repeated span in elements
+# min_repeats (int): minimum number of consecutive occurrences of a span to be reported
+# RETURNS: List of tuples (start index, span length, number of consecutive occurrences), ordered and non-overlapping
+def find_repetitions(keys, min_span=REPETITION_MIN_SPAN, max_span=REPETITION_MAX_SPAN,
+                     min_repeats=REPETITION_MIN_REPEATS):
+    key_count = len(keys)
+
+    # for every span length calculate for each position how many of the following elements match the element
+    # one span length further on. a span at position i is repeated 1 + runs[span][i] // span times in a row
+    runs = {}
+    for span in range(min_span, min(max_span, key_count // min_repeats) + 1):
+        run = [0] * (key_count + 1)
+        for i in range(key_count - span - 1, -1, -1):
+            if keys[i] == keys[i + span]:
+                run[i] = run[i + 1] + 1
+        runs[span] = run
+
+    repetitions = []
+    i = 0
+    while i < key_count:
+        # find the span starting at i that covers the most elements when repeated (prefer shorter spans on ties)
+        best_span, best_repeats = 0, 0
+        for span, run in runs.items():
+            repeats = 1 + run[i] // span
+            if repeats >= min_repeats and span * repeats > best_span * best_repeats:
+                best_span, best_repeats = span, repeats
+        if best_span:
+            repetitions.append((i, best_span, best_repeats))
+            i += best_span * best_repeats
+        else:
+            i += 1
+    return repetitions
+
+
+# Function to collapse spans of words that are repeated several times in a row down to a single occurrence.
+# Words are compared case-insensitively and without surrounding punctuation ("Thank you." matches "thank you,").
+# PARAMS:
+# text (string): text in which to collapse repetitions
+# min_span, max_span, min_repeats (int): see find_repetitions, counted in words
+# RETURNS: Tuple of the collapsed text (string) and a list of removals as tuples of
+# (word index in the original text, kept span (string), number of occurrences that were collapsed)
+def collapse_repetitions(text, min_span=REPETITION_MIN_SPAN, max_span=REPETITION_MAX_SPAN,
+                         min_repeats=REPETITION_MIN_REPEATS):
+    # split into words but keep the preceding whitespace with every word, so the text can be rebuilt unchanged
+    words = re.findall(r'\s*\S+', text)
+    trailing = text[sum(len(word) for word in words):]
+    keys = [word.strip().lower().strip(string.punctuation) or word.strip() for word in words]
+
+    collapsed = []
+    removed = []
+    position = 0
+    for start, span, repeats in find_repetitions(keys, min_span, max_span, min_repeats):
+        # keep only the first occurrence of the span and skip the repetitions
+        collapsed.extend(words[position:start + span])
+        removed.append((start, "".join(words[start:start + span]).strip(), repeats))
+        position = start + span * repeats
+    collapsed.extend(words[position:])
+
+    return "".join(collapsed) + trailing, removed
+
+
+# Function to knit text chunks piece by piece. Only the last maximum_overlap_length characters of the knitted text can
+# still change when the next chunk is stitched on, everything before them is final and yielded right away, so the
+# knitted text can be written out while knitting and is never copied as a whole.
+# PARAMS:
+# text_chunks (iterable of string): texts of all chunks in order (may be lazy, e.g. ChunkRecordReader.texts)
+# job (TranscriptionJob): chunking and knitting parameters
+# RETURNS: Generator of strings that make up the knitted text when concatenated
 # TODO: make more robust against unusual inputs (empty strings, etc.)
-def knit_texts(text_chunks):
-    # create new list for corrected texts
-    processed_chunks = []
-
-    # correct for repetition errors (Whisper sometimes repeats sentences multiple times for no apparent reason)
-    pattern = re.compile(r'(\D+?)\1{2,}')
-    for text in text_chunks:
-        processed_chunks.append(pattern.sub(r'\1', text))
-
-    # start final result with 0th time stamp and first half of first text chunk
-    result = "[" + convert_to_duration(0) + "] " + processed_chunks[0]
-
-    # iterate through all text chunks, stitch second half of previous chunk to first half of latter chunk
-    for index, value in enumerate(processed_chunks[1:]):
-        # calculate the base string on which to stitch the next chunk
-        # take last MAXIMUM_OVERLAP_LENGTH characters of current result if it is longer, otherwise just the whole result
-        base = result[-MAXIMUM_OVERLAP_LENGTH:] if len(result) > MAXIMUM_OVERLAP_LENGTH else result
-
-        rest1, overlap_text, rest2 = stitch_texts(base, value)
-        result = result[:-MAXIMUM_OVERLAP_LENGTH] + rest1
-        result += " [" + convert_to_duration((index + 1) * PIECE_LENGTH) + "]"
-
-        # check if overlap exists (in case, nothing was said during that time frame)
-        if overlap_text:
-            result += overlap_text if " " in [overlap_text[0], result[-1]] else " " + overlap_text
-        # check if rest2 exists (in case, nothing was said during that time frame)
-        if rest2:
-            result += rest2 if " " in [rest2[0], result[-1]] else " " + rest2
+def iterate_knitted_texts(text_chunks, job=None):
+    job = job or TranscriptionJob()
+    overlap_length = job.maximum_overlap_length
+    # end of the knitted text that may still change
+    result = ""
+
+    # iterate through all text chunks one at a time, stitch second half of previous chunk to first half of latter chunk
+    for index, text in enumerate(text_chunks):
+        # correct for repetition errors (Whisper sometimes repeats sentences multiple times for no apparent reason)
+        value, removed = collapse_repetitions(text, *job.repetition_parameters())
+        for position, span, repeats in removed:
+            print(f"Collapsed {repeats}x repetition in chunk {index} at word {position}: {span}")
+
+        # start final result with 0th time stamp and first half of first text chunk
+        if index == 0:
+            result = "[" + convert_to_duration(0) + "] " + value
+            continue
+
+        # the base string on which to stitch the next chunk are the last maximum_overlap_length characters of the
+        # current result (or the whole result if it is shorter), everything before them is final
+        if len(result) > overlap_length:
+            yield result[:-overlap_length]
+            result = result[-overlap_length:]
+
+        result = append_stitched_text(result, value, index, job)
+    yield result
+
+
+# Function to stitch the (repetition collapsed) text of chunk index onto the end of the knitted text
+# RETURNS: the end of the knitted text with the chunk's time stamp and text
+def append_stitched_text(result, value, index, job=None):
+    job = job or TranscriptionJob()
+    rest1, overlap_text, rest2 = stitch_texts(result, value, index, job)
+    result = rest1 + " [" + convert_to_duration(index * job.piece_length) + "]"
+
+    # check if overlap exists (in case, nothing was said during that time frame)
+    if overlap_text:
+        result += overlap_text if " " in [overlap_text[0], result[-1]] else " " + overlap_text
+    # check if rest2 exists (in case, nothing was said during that time frame)
+    if rest2:
+        result += rest2 if " " in [rest2[0], result[-1]] else " " + rest2
     return result
 
 
+def knit_texts(text_chunks, job=None):
+    return "".join(iterate_knitted_texts(text_chunks, job))
+
+
+# Function to stitch two successive chunks on their token IDs. Both chunks decode the same overlapping audio, so the
+# overlap is found as exactly equal runs of tokens between the end of tokens1 and the start of tokens2.
+# Tokens before the first run (end of tokens1 / start of tokens2) are kept from tokens1 and tokens after the last run
+# are kept from tokens2, since each chunk heard that audio on its own. Disagreements between two runs are resolved in
+# favour of the chunk with the higher average log-probability.
+# PARAMS:
+# tokens1, tokens2 (list of int): token IDs of the earlier and the later chunk
+# logprob1, logprob2 (float): average log-probability of the earlier and the later chunk
+# job (TranscriptionJob): holds the maximum overlap and minimum run length in tokens
+# RETURNS: Tuple of tokens1 before the overlap, merged overlap and tokens2 after the overlap (lists of int)
+def stitch_tokens(tokens1, tokens2, logprob1, logprob2, job=None):
+    job = job or TranscriptionJob()
+    base_start = max(len(tokens1) - job.maximum_overlap_tokens, 0)
+    base = tokens1[base_start:]
+    head = tokens2[:job.maximum_overlap_tokens]
+
+    # find runs of equal tokens, ignoring short runs that are likely coincidental (e.g. single common words)
+    seq_matcher = SequenceMatcher(None, base, head, autojunk=False)
+    blocks = [block for block in seq_matcher.get_matching_blocks() if block.size >= job.minimum_token_match]
+
+    # catch case in which there is no overlap (e.g. nothing was said during one of the chunks)
+    if not blocks:
+        return tokens1, [], tokens2
+
+    merged_overlap = []
+    for i, block in enumerate(blocks):
+        merged_overlap += base[block.a:block.a + block.size]
+        if i + 1 < len(blocks):
+            # resolve disagreement between this and the next run using the more confident chunk
+            next_block = blocks[i + 1]
+            if logprob1 >= logprob2:
+                merged_overlap += base[block.a + block.size:next_block.a]
+            else:
+                merged_overlap += head[block.b + block.size:next_block.b]
+
+    last_block = blocks[-1]
+    return tokens1[:base_start + blocks[0].a], merged_overlap, tokens2[last_block.b + last_block.size:]
+
+
+# Function to knit the token IDs of chunks piece by piece (counterpart of iterate_knitted_texts). Every piece holds
+# the tokens following one time stamp and is yielded as soon as the next chunk has been stitched on.
+# PARAMS:
+# chunks (iterable of tuples): token IDs of every chunk without special or timestamp tokens (list of int) and its
+# average log-probability (float), may be lazy
+# decode (function): converts a list of token IDs to a string (e.g. the decode method of Whisper's tokenizer)
+# job (TranscriptionJob): chunking and knitting parameters
+# RETURNS: Generator of strings that make up the knitted text with the same time stamps as knit_texts
+def iterate_knitted_tokens(chunks, decode, job=None):
+    job = job or TranscriptionJob()
+
+    def format_piece(index, tokens):
+        text = decode(tokens).strip()
+        if index == 0:
+            return "[" + convert_to_duration(0) + "] " + text
+        return " [" + convert_to_duration(index * job.piece_length) + "]" + (" " + text if text else "")
+
+    previous_tokens, previous_logprob = None, None
+    for index, (tokens, logprob) in enumerate(chunks):
+        # correct for repetition errors on the tokens directly
+        collapsed = []
+        position = 0
+        for start, span, repeats in find_repetitions(tokens, *job.repetition_parameters()):
+            collapsed += tokens[position:start + span]
+            position = start + span * repeats
+            print(f"Collapsed {repeats}x repetition in chunk {index} at token {start}: "
+                  f"{decode(tokens[start:start + span])}")
+        tokens = collapsed + tokens[position:]
+
+        if index > 0:
+            rest1, overlap_tokens, rest2 = stitch_tokens(previous_tokens, tokens, previous_logprob, logprob, job)
+            yield format_piece(index - 1, rest1)
+            tokens = overlap_tokens + rest2
+        previous_tokens, previous_logprob = tokens, logprob
+    if previous_tokens is not None:
+        yield format_piece(index, previous_tokens)
+
+
+# Function to knit the token IDs of all chunks into one text (counterpart of knit_texts)
+# PARAMS:
+# token_chunks (list of list of int): token IDs of every chunk without special or timestamp tokens
+# logprobs (list of float): average log-probability of every chunk
+# decode (function): converts a list of token IDs to a string (e.g. the decode method of Whisper's tokenizer)
+# RETURNS: knitted text (string) with the same time stamps as knit_texts
+def knit_tokens(token_chunks, logprobs, decode, job=None):
+    return "".join(iterate_knitted_tokens(zip(token_chunks, logprobs), decode, job))
+
+
 def convert_to_duration(count_seconds):
     return f'{count_seconds // 3600:02d}:{count_seconds % 3600 // 60:02d}:{count_seconds % 60:02d}'
@@ -2,11 +2,22 @@ import whisper
 import torch
 import tkinter as tk
 
-from Tools import open_file, get_file_duration
+from Tools import open_file, get_file_duration, bound_heap_growth, StageProfiler
+from Decoding import iterate_block_transcription
+from Scheduling import choose_model, record_real_time_factor, write_job_metadata, get_profile_mode, DEFAULT_CANDIDATE, \
+    DECODING_SETTINGS
 import threading
 import time
 import os
 
+# Define the time available for transcribing a file in seconds. If set, the model and decoding settings are chosen
+# from the real-time factors measured on this machine when the model is loaded (load the file first), see Scheduling.py
+DEADLINE_SECONDS = None
+
+# Define whether to keep the memory usage independent of the recording's length (for recordings of many hours): the
+# recording is transcribed in blocks (see Decoding.iterate_block_transcription) and written out block by block
+BOUNDED_MEMORY = False
+
 
 class TranscriptionApp:
     def __init__(self):
@@ -17,12 +28,19 @@ class TranscriptionApp:
         self.filepath = ""
         self.size = 0
         self.model = None
+        self.model_name, self.settings_name = "large-v2", DEFAULT_CANDIDATE[1]
+        self.decision = None
 
         self._setup_window()
 
     def load_model(self):
         self.label_model["text"] = "Loading..."
-        self.model = whisper.load_model("large-v2", device="cpu")
+        self.decision = None
+        if DEADLINE_SECONDS is not None and self.filepath:
+            self.decision = choose_model(get_file_duration(self.filepath), DEADLINE_SECONDS,
+                                         get_profile_mode("whole", blocks=BOUNDED_MEMORY))
+            self.model_name, self.settings_name = self.decision["model"], self.decision["settings"]
+        self.model = whisper.load_model(self.model_name, device="cpu")
         self.model.encoder.to("cuda:0")
         self.model.decoder.to("cuda:1")
 
@@ -59,7 +77,18 @@ class TranscriptionApp:
         # Start the print_time function in a separate thread
         threading.Thread(target=print_time, daemon=True).start()
 
-        result = self.model.transcribe(self.filepath)
+        profiler = StageProfiler(audio_length, trace_memory=False)
+        with profiler.stage("transcribe"):
+            if BOUNDED_MEMORY:
+                bound_heap_growth()
+                # write every segment as soon as its block is transcribed
+                with open("Transcription/output.txt", "w", encoding="utf-8") as outFile:
+                    for index, (_, _, text) in enumerate(iterate_block_transcription(
+                            self.model, self.filepath, audio_length,
+                            decoding_options=DECODING_SETTINGS[self.settings_name])):
+                        outFile.write(" " + text if index else text)
+            else:
+                result = self.model.transcribe(self.filepath, **DECODING_SETTINGS[self.settings_name])
 
         done_event.set()
 
@@ -74,10 +103,18 @@ class TranscriptionApp:
             outFile.write(f"\n{normalized_duration}; "
                           f"{audio_length}; "
                           f"{os.path.basename(self.filepath)}; whole")
-
-        with open("Transcription/output.txt", "w", encoding="utf-8") as outFile:
-            outFile.write(result["text"])
+        record_real_time_factor(get_profile_mode("whole", blocks=BOUNDED_MEMORY), self.model_name, self.settings_name,
+                                time_taken / audio_length)
+        if self.decision is not None:
+            write_job_metadata(self.filepath, dict(self.decision, actual_seconds=time_taken,
+                                                   met_deadline=time_taken <= self.decision["deadline_seconds"]))
+
+        if not BOUNDED_MEMORY:
+            with profiler.stage("write"), open("Transcription/output.txt", "w", encoding="utf-8") as outFile:
+                outFile.write(result["text"])
         print("Transcription complete. See output.txt")
+        profiler.report()
+        profiler.write_statistics("Transcription/memory_statistics.txt", f"{os.path.basename(self.filepath)}; whole")
 
     # Define the loading function
     def load_file(self):
@@ -4,12 +4,51 @@ import tkinter as tk
 from tkinter import ttk
 
 import Tools
-from Tools import open_file, process_file, knit_texts
+from Decoding import transcribe_chunks, transcribe_recording, transcribe_sliding
+from ChunkRecords import ChunkRecordWriter, ChunkRecordReader
+from Scheduling import choose_model, record_real_time_factor, write_job_metadata, get_profile_mode, DEFAULT_CANDIDATE, \
+    DECODING_SETTINGS
+from Tools import open_file, process_file, iterate_knitted_texts, iterate_knitted_tokens, StageProfiler
 from queue import Queue, Empty
 import threading
 import time
 import os
 
+# Define whether to stitch the chunks on Whisper's token IDs (knit_tokens) instead of on their texts (knit_texts)
+KNIT_ON_TOKENS = False
+
+# Define whether to stop decoding a chunk as soon as Whisper falls into a repetition loop
+STOP_REPETITION_LOOPS = False
+
+# Define how to transcribe: "chunked" decodes fixed overlapping chunks and knits them, "sliding" decodes with
+# timestamps and moves the window to the end of the last complete segment (no splitting and no knitting required)
+TRANSCRIPTION_MODE = "chunked"
+
+# Define whether to slice the chunks' log-Mel spectrograms out of the spectrogram of the whole recording (computed in
+# blocks) instead of splitting the recording into chunk files and computing a spectrogram for every padded chunk
+SLICE_RECORDING_MEL = False
+
+# Define a small Whisper model (e.g. "tiny" or "base") to decode speculatively with: it proposes tokens that the
+# large model verifies in one pass, the transcript stays the same as with greedy decoding (None to decode normally)
+DRAFT_MODEL = None
+
+# Define whether to keep the model on the CPU and run its encoder and decoder as two pipeline stages with their own
+# thread budgets (the encoder encodes the next chunk while the decoder decodes the current one)
+CPU_PIPELINE = False
+
+# Define whether to keep the memory usage independent of the recording's length (for recordings of many hours): the
+# chunks' results are only streamed to the chunk records and read back from there for knitting
+BOUNDED_MEMORY = False
+
+# Define whether to skip decoding chunks without speech: chunks quieter than the job's silence threshold are neither
+# encoded nor decoded, the others only if the no-speech probability after the first decoder step stays below the job's
+# threshold (see Decoding.decode_chunk_mels). Skipped chunks get an empty transcript.
+SKIP_NO_SPEECH = False
+
+# Define the time available for transcribing a file in seconds. If set, the model and decoding settings are chosen
+# from the real-time factors measured on this machine when the model is loaded (load the file first), see Scheduling.py
+DEADLINE_SECONDS = None
+
 
 class TranscriptionApp:
     def __init__(self):
@@ -28,23 +67,41 @@ class TranscriptionApp:
         self.progress_queue = Queue()
         self.filepath = ""
         self.audio_pieces = []
+        # chunking and knitting parameters and state of the loaded file's transcription
+        self.job = Tools.TranscriptionJob(bounded_memory=BOUNDED_MEMORY, skip_no_speech=SKIP_NO_SPEECH)
+        # wall time and peak memory of every stage of the loaded file's transcription
+        self.profiler = None
         self.size = 0
         self.model = None
+        self.draft_model = None
+        self.model_name, self.settings_name = DEFAULT_CANDIDATE
+        self.decision = None
 
         self._setup_window()
 
     def load_model(self):
         self.label_model["text"] = "Loading..."
-        self.model = whisper.load_model("large-v3", device="cpu")
-        self.model.encoder.to("cuda:0")
-        self.model.decoder.to("cuda:1")
-
-        self.model.decoder.register_forward_pre_hook(lambda _, inputs:
-                                                     tuple([inputs[0].to("cuda:1"),
-                                                            inputs[1].to("cuda:1")] + list(inputs[2:])))
-        self.model.decoder.register_forward_hook(lambda _, inputs, outputs: outputs.to("cuda:0"))
-
-        self.label_model["text"] = "Model loaded"
+        self.decision = None
+        if DEADLINE_SECONDS is not None and self.filepath:
+            # speculative decoding only reproduces greedy decoding
+            self.decision = choose_model(Tools.get_file_duration(self.filepath), DEADLINE_SECONDS,
+                                         self._get_profile_mode(),
+                                         ["greedy"] if DRAFT_MODEL is not None and TRANSCRIPTION_MODE == "chunked"
+                                         else None)
+            self.model_name, self.settings_name = self.decision["model"], self.decision["settings"]
+        self.model = whisper.load_model(self.model_name, device="cpu")
+        if not CPU_PIPELINE:
+            self.model.encoder.to("cuda:0")
+            self.model.decoder.to("cuda:1")
+
+            self.model.decoder.register_forward_pre_hook(lambda _, inputs:
+                                                         tuple([inputs[0].to("cuda:1"),
+                                                                inputs[1].to("cuda:1")] + list(inputs[2:])))
+            self.model.decoder.register_forward_hook(lambda _, inputs, outputs: outputs.to("cuda:0"))
+        if DRAFT_MODEL is not None:
+            self.draft_model = whisper.load_model(DRAFT_MODEL, device="cpu" if CPU_PIPELINE else "cuda:0")
+
+        self.label_model["text"] = f"Model loaded ({self.model_name}, {self.settings_name})"
 
     def start_transcribing(self):
         self.maximum_queue = Queue()
@@ -57,72 +114,159 @@ class TranscriptionApp:
         work_thread.start()
 
     def _transcribe_work(self):
-        assert self.audio_pieces
+        if TRANSCRIPTION_MODE == "sliding":
+            self._transcribe_sliding_work()
+            return
+        assert self.audio_pieces or SLICE_RECORDING_MEL
         assert self.filepath
 
         start_time = time.time()  # This is when the transcription process begins
 
-        results = []
-        total_audio_pieces = len(self.audio_pieces)
+        audio_length = Tools.get_file_duration(self.filepath)
+        total_audio_pieces = Tools.get_piece_count(audio_length, self.job) if SLICE_RECORDING_MEL \
+            else len(self.audio_pieces)
         self.progress_bar.pack()
         self.maximum_queue.put(total_audio_pieces)
-        audio_length = Tools.get_file_duration(self.filepath)
         print(f"Starting transcription... Recording duration: "
               f"{round(audio_length // 60)}:{round(audio_length % 60):02d} minutes.")
         estimate = audio_length * 1341 / (60*60)
         print(f"Estimated transcription time: {round(estimate // 60)}:{round(estimate % 60):02d} minutes.")
 
-        for idx, audio_path in enumerate(self.audio_pieces):
-            audio = whisper.load_audio(audio_path)
-            audio = whisper.pad_or_trim(audio)
-
-            # make log-Mel spectrogram and move to the same device as the model
-            mel = whisper.log_mel_spectrogram(audio, n_mels=128).to(self.model.device)
-
-            if idx == 0:
-                # detect the spoken language
-                _, probs = self.model.detect_language(mel)
-                print(f"Detected language: {max(probs, key=probs.get)}")
-
-            # decode the audio
-            options = whisper.DecodingOptions(fp16=False)
-            result = whisper.decode(self.model, mel, options)
-            results.append(result.text)
-            elapsed_time = time.time() - start_time
-            elapsed_minutes = int(elapsed_time // 60)
-            elapsed_seconds = int(elapsed_time % 60)
-            print(f"{idx + 1}/{total_audio_pieces} - t.e. {elapsed_minutes:02d}:{elapsed_seconds:02d}")
-
-            self.progress_queue.put(idx + 1)  # Update the progress queue
-
         base_name = os.path.basename(self.filepath).split('.')[0]
         output_name = base_name + ".txt"
-        output_name_long = base_name + "_long.txt"
-
-        with open(f"Transcription/results/{output_name_long}", "w", encoding="utf-8") as outFile:
-            for text in results:
-                outFile.write(text)
-                outFile.write('\n' * 2)
-        print("finished writing long output.")
+        output_name_chunks = base_name + "_chunks.jsonl"
+
+        # stream every chunk's result to the chunk records while transcribing
+        with self.profiler.stage("decode"), \
+                ChunkRecordWriter(f"Transcription/results/{output_name_chunks}") as record_writer:
+            if SLICE_RECORDING_MEL:
+                _, tokenizer, truncated_chunks, decoding_durations = \
+                    transcribe_recording(self.model, self.filepath, audio_length, self.progress_queue,
+                                         STOP_REPETITION_LOOPS, record_writer, DECODING_SETTINGS[self.settings_name],
+                                         self.draft_model, pipeline=CPU_PIPELINE, job=self.job)
+            else:
+                _, tokenizer, truncated_chunks, decoding_durations = \
+                    transcribe_chunks(self.model, self.audio_pieces, self.progress_queue, STOP_REPETITION_LOOPS,
+                                      record_writer, DECODING_SETTINGS[self.settings_name], self.draft_model,
+                                      pipeline=CPU_PIPELINE, job=self.job)
+        print("finished writing chunk records.")
 
         end_time = time.time()  # This is when the transcription process ends
 
         time_taken = end_time - start_time  # This will give the time taken in seconds
         print(f"Transcription took {round(time_taken // 60)}:{round(time_taken % 60):02d} minutes.")
         # transcription duration in seconds normalized to 1 hour recording time
-        normalized_duration = time_taken/total_audio_pieces*3600/Tools.PIECE_LENGTH
+        normalized_duration = time_taken/total_audio_pieces*3600/self.job.piece_length
         print(f"Duration (normalized to 1h recording time): {round(normalized_duration // 60)}:{round(normalized_duration % 60):02d} minutes.")
         with open("Transcription/duration_statistics.txt", "a") as outFile:
             outFile.write(f"\n{normalized_duration}; "
-                          f"{total_audio_pieces*Tools.PIECE_LENGTH}; "
+                          f"{total_audio_pieces*self.job.piece_length}; "
                           f"{os.path.basename(self.filepath)}; chunked")
+        self._record_timing(time_taken, total_audio_pieces*self.job.piece_length)
+        if STOP_REPETITION_LOOPS:
+            # record how many chunks looped and which share of the decoding time they took
+            truncated_duration = sum(decoding_durations[idx] for idx in truncated_chunks)
+            print(f"Stopped {len(truncated_chunks)}/{total_audio_pieces} chunks early, taking "
+                  f"{round(100 * truncated_duration / sum(decoding_durations))}% of the decoding time.")
+            with open("Transcription/truncation_statistics.txt", "a") as outFile:
+                outFile.write(f"\n{len(truncated_chunks)}; "
+                              f"{total_audio_pieces}; "
+                              f"{truncated_duration}; "
+                              f"{sum(decoding_durations)}; "
+                              f"{os.path.basename(self.filepath)}; "
+                              f"{','.join(str(idx) for idx in truncated_chunks)}")
+        if SKIP_NO_SPEECH:
+            # record how many chunks were skipped and which share of the decoding time they still took
+            skipped_indices = [idx for idx, _ in self.job.skipped_chunks]
+            silent_count = sum(1 for _, reason in self.job.skipped_chunks if reason == "silence")
+            skipped_duration = sum(decoding_durations[idx] for idx in skipped_indices)
+            with open("Transcription/skip_statistics.txt", "a") as outFile:
+                outFile.write(f"\n{len(skipped_indices)}; "
+                              f"{total_audio_pieces}; "
+                              f"{silent_count}; "
+                              f"{len(skipped_indices) - silent_count}; "
+                              f"{skipped_duration}; "
+                              f"{sum(decoding_durations)}; "
+                              f"{os.path.basename(self.filepath)}; "
+                              f"{','.join(str(idx) for idx in skipped_indices)}")
         print("")
         print("knitting results...")
-        total_result = knit_texts(results)
+        chunk_records = ChunkRecordReader(f"Transcription/results/{output_name_chunks}")
+        if KNIT_ON_TOKENS:
+            # stitch on the text tokens (without timestamp tokens) using the confidence of every chunk
+            knitted_parts = iterate_knitted_tokens(
+                (([token for token in record["tokens"] if token < tokenizer.timestamp_begin], record["avg_logprob"])
+                 for record in chunk_records), tokenizer.decode, self.job)
+        else:
+            knitted_parts = iterate_knitted_texts(chunk_records.texts(), self.job)
+
+        # write the knitted text while knitting, it is never held in memory as a whole
+        with self.profiler.stage("knit"), \
+                open(f"Transcription/results/{output_name}", "w", encoding="utf-8") as outFile:
+            for part in knitted_parts:
+                outFile.write(part)
+        print(f"Transcription complete. See results/{output_name}")
+        self._report_memory("chunked")
+
+    def _transcribe_sliding_work(self):
+        assert self.filepath
+
+        start_time = time.time()  # This is when the transcription process begins
+
+        self.progress_bar.pack()
+        audio_length = Tools.get_file_duration(self.filepath)
+        self.maximum_queue.put(int(audio_length))
+        print(f"Starting transcription... Recording duration: "
+              f"{round(audio_length // 60)}:{round(audio_length % 60):02d} minutes.")
+
+        with self.profiler.stage("decode"):
+            total_result, _, window_count = transcribe_sliding(self.model, self.filepath, audio_length,
+                                                               self.progress_queue,
+                                                               DECODING_SETTINGS[self.settings_name])
+
+        time_taken = time.time() - start_time  # This will give the time taken in seconds
+        print(f"Transcription of {window_count} windows took {round(time_taken // 60)}:{round(time_taken % 60):02d} "
+              f"minutes.")
+        # transcription duration in seconds normalized to 1 hour recording time
+        normalized_duration = time_taken/audio_length*3600
+        print(f"Duration (normalized to 1h recording time): {round(normalized_duration // 60)}:"
+              f"{round(normalized_duration % 60):02d} minutes.")
+        with open("Transcription/duration_statistics.txt", "a") as outFile:
+            outFile.write(f"\n{normalized_duration}; "
+                          f"{audio_length}; "
+                          f"{os.path.basename(self.filepath)}; sliding")
+        self._record_timing(time_taken, audio_length)
 
+        output_name = os.path.basename(self.filepath).split('.')[0] + ".txt"
         with open(f"Transcription/results/{output_name}", "w", encoding="utf-8") as outFile:
             outFile.write(total_result)
         print(f"Transcription complete. See results/{output_name}")
+        self._report_memory("sliding")
+
+    # Function to print and store the wall time and peak resident set size of every stage of the transcription
+    def _report_memory(self, mode):
+        self.profiler.report()
+        self.profiler.write_statistics("Transcription/memory_statistics.txt",
+                                       f"{os.path.basename(self.filepath)}; {mode}")
+
+    # Function to get the mode the real-time factors of this configuration are profiled under (see
+    # Scheduling.get_profile_mode), the sliding mode uses none of the options of the chunked mode
+    def _get_profile_mode(self):
+        if TRANSCRIPTION_MODE == "sliding":
+            return TRANSCRIPTION_MODE
+        return get_profile_mode(TRANSCRIPTION_MODE, pipeline=CPU_PIPELINE, draft=DRAFT_MODEL,
+                                sliced_mel=SLICE_RECORDING_MEL, stop_loops=STOP_REPETITION_LOOPS)
+
+    # Function to update the real-time factor of the loaded model on this machine and the job's scheduling metadata
+    def _record_timing(self, time_taken, audio_length):
+        # skipping chunks without speech makes the speed depend on the recording instead of the machine, so such runs
+        # would make the profile too optimistic for other recordings
+        if not (TRANSCRIPTION_MODE == "chunked" and SKIP_NO_SPEECH):
+            record_real_time_factor(self._get_profile_mode(), self.model_name, self.settings_name,
+                                    time_taken / audio_length)
+        if self.decision is not None:
+            write_job_metadata(self.filepath, dict(self.decision, actual_seconds=time_taken,
+                                                   met_deadline=time_taken <= self.decision["deadline_seconds"]))
 
     def update_gui(self):
         maximum = -1
@@ -157,9 +301,17 @@ class TranscriptionApp:
         self.label_file["text"] = "Loading..."
 
         self.filepath = open_file()
+        self.job = Tools.TranscriptionJob(bounded_memory=BOUNDED_MEMORY, skip_no_speech=SKIP_NO_SPEECH)
 
         def work():
-            self.audio_pieces = process_file(self.filepath, self.progress_queue, self.maximum_queue)
+            self.profiler = StageProfiler(Tools.get_file_duration(self.filepath), trace_memory=False)
+            # the sliding mode and the sliced spectrograms read the audio directly from the source file
+            if TRANSCRIPTION_MODE == "sliding" or SLICE_RECORDING_MEL:
+                self.maximum_queue.put(0)
+            else:
+                with self.profiler.stage("split"):
+                    self.audio_pieces = process_file(self.filepath, self.progress_queue, self.maximum_queue,
+                                                     self.job)
             self.progress_bar.pack_forget()
             self.label_file["text"] = os.path.basename(self.filepath)
 